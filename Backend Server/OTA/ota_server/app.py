@@ -15,7 +15,7 @@ from typing import Dict, Any, Optional
 from functools import wraps
 import threading
 import time
-from database import register_device, get_device, update_device_status, get_all_devices, set_force_update, set_force_restart
+from database import register_device, get_device, update_device_status, get_all_devices, set_force_update, set_force_restart, ensure_indexes
 
 # Load configuration
 def load_config() -> Dict[str, Any]:
@@ -48,6 +48,213 @@ def setup_logging():
 
 logger = setup_logging()
 
+# Read size for hashing; large reads keep syscall overhead negligible for multi-MB images
+HASH_READ_SIZE = 1024 * 1024
+
+def write_json_atomic(path: str, data: Any, **dump_kwargs):
+    """Write-then-rename, so a crash or a concurrent reader never sees a partial file"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(data, f, **dump_kwargs)
+    os.replace(temp_path, path)
+
+class HashIndex:
+    """SHA-256 of firmware files, persisted as JSON next to the firmware.
+
+    Entries are keyed by path and trusted only while the file's size,
+    mtime_ns and inode are unchanged, so a hit costs one stat() call.
+    """
+
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self.counters = {'hits': 0, 'misses': 0}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            entries = {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable hash index {self.index_path}: {str(e)}")
+            entries = {}
+        with self._lock:
+            # Drop entries for files removed while the server was down
+            self._entries = {path: entry for path, entry in entries.items() if os.path.exists(path)}
+
+    def _save(self):
+        write_json_atomic(self.index_path, self._entries)
+
+    @staticmethod
+    def _signature(file_path: str) -> Dict[str, int]:
+        st = os.stat(file_path)
+        return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'inode': st.st_ino}
+
+    @staticmethod
+    def compute(file_path: str) -> str:
+        sha256_hash = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_READ_SIZE), b""):
+                sha256_hash.update(block)
+        return sha256_hash.hexdigest()
+
+    def get(self, file_path: str) -> str:
+        file_path = os.path.abspath(file_path)
+        signature = self._signature(file_path)
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is not None and all(entry.get(k) == v for k, v in signature.items()):
+                self.counters['hits'] += 1
+                return entry['sha256']
+            self.counters['misses'] += 1
+        return self.put(file_path, self.compute(file_path), signature)
+
+    def put(self, file_path: str, file_hash: str, signature: Optional[Dict[str, int]] = None) -> str:
+        """Record a hash already known for file_path, e.g. computed before a move or copy."""
+        file_path = os.path.abspath(file_path)
+        signature = signature or self._signature(file_path)
+        with self._lock:
+            self._entries[file_path] = {**signature, 'sha256': file_hash}
+            self._save()
+        return file_hash
+
+    def remove(self, file_path: str):
+        with self._lock:
+            if self._entries.pop(os.path.abspath(file_path), None) is not None:
+                self._save()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'entries': len(self._entries), **self.counters}
+
+class FirmwareCatalog:
+    """Index of the firmware images, persisted as a JSON manifest.
+
+    Each entry records channel ("main" or "backup"), filename, size, hash,
+    upload time and a sequence number. The latest firmware is the main
+    entry with the highest sequence, so it no longer depends on file ctime.
+    Upload, restore and delete update the catalog; rebuild() reconciles it
+    with whatever is on disk.
+    """
+
+    CHANNELS = ('main', 'backup')
+
+    def __init__(self, manifest_path: str, folders: Dict[str, str], hashes: HashIndex):
+        self.manifest_path = manifest_path
+        self.folders = folders
+        self.hashes = hashes
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._sequence = 0
+        self.load()
+
+    @staticmethod
+    def _key(channel: str, filename: str) -> str:
+        return f"{channel}/{filename}"
+
+    def path(self, entry: Dict[str, Any]) -> str:
+        return os.path.join(self.folders[entry['channel']], entry['filename'])
+
+    def load(self):
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+            with self._lock:
+                self._entries = {self._key(e['channel'], e['filename']): e for e in manifest['firmware']}
+                self._sequence = manifest.get('sequence', 0)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Rebuilding unreadable firmware manifest {self.manifest_path}: {str(e)}")
+        # Pick up files added or removed while the server was down
+        self.rebuild()
+
+    def _save(self):
+        write_json_atomic(self.manifest_path, {'sequence': self._sequence, 'firmware': list(self._entries.values())}, indent=2)
+
+    def _entry(self, channel: str, filename: str, file_hash: Optional[str], uploaded_at: Optional[str] = None):
+        file_path = os.path.join(self.folders[channel], filename)
+        st = os.stat(file_path)
+        self._sequence += 1
+        return {
+            'channel': channel,
+            'filename': filename,
+            'size': st.st_size,
+            'hash': file_hash or self.hashes.get(file_path),
+            'last_modified': datetime.fromtimestamp(st.st_mtime).isoformat(),
+            'uploaded_at': uploaded_at or datetime.now().isoformat(),
+            'sequence': self._sequence,
+        }
+
+    def add(self, channel: str, filename: str, file_hash: Optional[str] = None) -> Dict[str, Any]:
+        """Record a file just written to a channel folder; it becomes that channel's newest entry."""
+        with self._lock:
+            entry = self._entry(channel, filename, file_hash)
+            self._entries[self._key(channel, filename)] = entry
+            self._save()
+            return dict(entry)
+
+    def remove(self, channel: str, filename: str) -> bool:
+        with self._lock:
+            if self._entries.pop(self._key(channel, filename), None) is None:
+                return False
+            self._save()
+            return True
+
+    def rebuild(self) -> Dict[str, int]:
+        """Reconcile the catalog with the firmware folders.
+
+        Known files keep their upload time and order. Files new to the catalog
+        are appended in mtime order, the best ordering left on disk.
+        """
+        found = []
+        for channel in self.CHANNELS:
+            for filename in os.listdir(self.folders[channel]):
+                if filename.endswith('.bin') and not filename.startswith('.'):
+                    path = os.path.join(self.folders[channel], filename)
+                    found.append((os.path.getmtime(path), channel, filename))
+        with self._lock:
+            entries, added, updated = {}, 0, 0
+            for _, channel, filename in sorted(found):
+                key = self._key(channel, filename)
+                entry = self._entries.get(key)
+                size = os.path.getsize(os.path.join(self.folders[channel], filename))
+                if entry is None:
+                    entry = self._entry(channel, filename, None)
+                    added += 1
+                elif entry['size'] != size or entry['hash'] != self.hashes.get(self.path(entry)):
+                    # Replaced outside the server; keep its place in the order
+                    entry = {**self._entry(channel, filename, None, entry['uploaded_at']), 'sequence': entry['sequence']}
+                    updated += 1
+                entries[key] = entry
+            removed = len(set(self._entries) - set(entries))
+            self._entries = entries
+            self._save()
+        if added or updated or removed:
+            logger.info(f"Firmware catalog rebuilt: {added} added, {updated} updated, {removed} removed")
+        return {'added': added, 'updated': updated, 'removed': removed, 'total': len(entries)}
+
+    def entries(self, channel: Optional[str] = None) -> list:
+        with self._lock:
+            entries = [dict(e) for e in self._entries.values() if channel is None or e['channel'] == channel]
+        return sorted(entries, key=lambda e: e['sequence'])
+
+    def latest(self) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            main = [e for e in self._entries.values() if e['channel'] == 'main']
+            return dict(max(main, key=lambda e: e['sequence'])) if main else None
+
+    def totals(self) -> Dict[str, Dict[str, int]]:
+        totals = {channel: {'count': 0, 'size': 0} for channel in self.CHANNELS}
+        with self._lock:
+            for entry in self._entries.values():
+                totals[entry['channel']]['count'] += 1
+                totals[entry['channel']]['size'] += entry['size']
+        return totals
+
 # Firmware management
 class FirmwareManager:
     def __init__(self):
@@ -57,6 +264,12 @@ class FirmwareManager:
         os.makedirs(self.firmware_folder, exist_ok=True)
         os.makedirs(self.backup_folder, exist_ok=True)
         os.makedirs(self.temp_folder, exist_ok=True)
+        self.hashes = HashIndex(os.path.join(
+            self.firmware_folder, config['firmware'].get('hash_index_file', '.hash_index.json')))
+        self.catalog = FirmwareCatalog(
+            os.path.join(self.firmware_folder, config['firmware'].get('version_file', 'version.json')),
+            {'main': self.firmware_folder, 'backup': self.backup_folder},
+            self.hashes)
     
     def validate_firmware(self, file_path: str) -> tuple[bool, str]:
         """Validate firmware file"""
@@ -79,19 +292,11 @@ class FirmwareManager:
             return False, f"Error validating firmware: {str(e)}"
     
     def get_latest_firmware(self) -> Optional[str]:
-        firmware_files = [f for f in os.listdir(self.firmware_folder) 
-                         if f.endswith('.bin') and not f.startswith('.')]
-        if not firmware_files:
-            return None
-        return max(firmware_files, 
-                  key=lambda x: os.path.getctime(os.path.join(self.firmware_folder, x)))
+        latest = self.catalog.latest()
+        return latest['filename'] if latest else None
     
     def calculate_hash(self, file_path: str) -> str:
-        sha256_hash = hashlib.sha256()
-        with open(file_path, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
+        return self.hashes.get(file_path)
     
     def backup_firmware(self, filename: str):
         if not config['firmware']['backup_enabled']:
@@ -99,10 +304,12 @@ class FirmwareManager:
         
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         backup_name = f"{os.path.splitext(filename)[0]}_{timestamp}.bin"
-        shutil.copy2(
-            os.path.join(self.firmware_folder, filename),
-            os.path.join(self.backup_folder, backup_name)
-        )
+        source_path = os.path.join(self.firmware_folder, filename)
+        backup_path = os.path.join(self.backup_folder, backup_name)
+        shutil.copy2(source_path, backup_path)
+        # The copy has the same content, so it inherits the hash instead of being re-read
+        file_hash = self.hashes.put(backup_path, self.calculate_hash(source_path))
+        self.catalog.add('backup', backup_name, file_hash)
         logger.info(f"Created backup: {backup_name}")
 
     def cleanup_temp_files(self):
@@ -219,8 +426,8 @@ def upload_firmware():
                 os.remove(temp_path)
                 return jsonify({'error': f'File too large (max {config["firmware"]["max_size_mb"]}MB)'}), 400
             
-            # Calculate hash
-            file_hash = firmware_manager.calculate_hash(temp_path)
+            # Calculate hash once, at upload; it is recorded for the final path below
+            file_hash = HashIndex.compute(temp_path)
             
             # Move to final location
             final_filename = secure_filename(file.filename)
@@ -232,6 +439,8 @@ def upload_firmware():
             
             # Move the file
             shutil.move(temp_path, final_path)
+            firmware_manager.hashes.put(final_path, file_hash)
+            entry = firmware_manager.catalog.add('main', final_filename, file_hash)
             
             logger.info(f"New firmware uploaded: {final_filename} (Hash: {file_hash})")
             
@@ -240,7 +449,7 @@ def upload_firmware():
                 'filename': final_filename,
                 'hash': file_hash,
                 'size': size,
-                'upload_date': datetime.now().isoformat()
+                'upload_date': entry['uploaded_at']
             })
             
         except Exception as e:
@@ -286,21 +495,16 @@ def verify_firmware(filename):
 def get_version():
     """Return the current firmware version and metadata"""
     try:
-        latest_firmware = firmware_manager.get_latest_firmware()
-        if not latest_firmware:
+        latest = firmware_manager.catalog.latest()
+        if not latest:
             return jsonify({'error': 'No firmware available'}), 404
         
-        firmware_path = os.path.join(firmware_manager.firmware_folder, latest_firmware)
-        file_hash = firmware_manager.calculate_hash(firmware_path)
-        file_size = os.path.getsize(firmware_path)
-        last_modified = datetime.fromtimestamp(os.path.getmtime(firmware_path))
-        
         return jsonify({
-            'version': latest_firmware,
+            'version': latest['filename'],
             'url': '/firmware',
-            'hash': file_hash,
-            'size': file_size,
-            'last_modified': last_modified.isoformat(),
+            'hash': latest['hash'],
+            'size': latest['size'],
+            'last_modified': latest['last_modified'],
             'build_date': datetime.now().isoformat()
         })
     except Exception as e:
@@ -345,29 +549,19 @@ def health_check():
 def firmware_history():
     """Get firmware version history"""
     try:
-        firmware_files = []
-        # Main firmware folder
-        for file in os.listdir(firmware_manager.firmware_folder):
-            if file.endswith('.bin'):
-                file_path = os.path.join(firmware_manager.firmware_folder, file)
-                firmware_files.append({
-                    'filename': file,
-                    'size': os.path.getsize(file_path),
-                    'last_modified': datetime.fromtimestamp(os.path.getmtime(file_path)).isoformat(),
-                    'hash': firmware_manager.calculate_hash(file_path)
-                })
-        # Backup folder
-        backup_folder = os.path.join(firmware_manager.firmware_folder, 'backup')
-        if os.path.exists(backup_folder):
-            for file in os.listdir(backup_folder):
-                if file.endswith('.bin'):
-                    file_path = os.path.join(backup_folder, file)
-                    firmware_files.append({
-                        'filename': file,
-                        'size': os.path.getsize(file_path),
-                        'last_modified': datetime.fromtimestamp(os.path.getmtime(file_path)).isoformat(),
-                        'hash': firmware_manager.calculate_hash(file_path)
-                    })
+        # Main firmware first, then backups
+        firmware_files = [
+            {
+                'filename': entry['filename'],
+                'size': entry['size'],
+                'last_modified': entry['last_modified'],
+                'hash': entry['hash'],
+                'channel': entry['channel'],
+                'uploaded_at': entry['uploaded_at']
+            }
+            for channel in FirmwareCatalog.CHANNELS
+            for entry in firmware_manager.catalog.entries(channel)
+        ]
         return jsonify(firmware_files)
     except Exception as e:
         logger.error(f"Error getting firmware history: {str(e)}")
@@ -387,8 +581,11 @@ def restore_firmware(filename):
         if current_firmware:
             firmware_manager.backup_firmware(current_firmware)
         
-        # Restore the backup
-        shutil.copy2(backup_path, os.path.join(firmware_manager.firmware_folder, filename))
+        # Restore the backup; it becomes the latest firmware
+        restored_path = os.path.join(firmware_manager.firmware_folder, filename)
+        shutil.copy2(backup_path, restored_path)
+        file_hash = firmware_manager.hashes.put(restored_path, firmware_manager.calculate_hash(backup_path))
+        firmware_manager.catalog.add('main', filename, file_hash)
         return jsonify({'message': 'Firmware restored successfully'})
     except Exception as e:
         logger.error(f"Error restoring firmware: {str(e)}")
@@ -404,12 +601,16 @@ def delete_firmware(filename):
         file_path = os.path.join(firmware_manager.firmware_folder, filename)
         if os.path.exists(file_path):
             os.remove(file_path)
+            firmware_manager.hashes.remove(file_path)
+            firmware_manager.catalog.remove('main', filename)
             deleted = True
         # Backup folder
         backup_folder = os.path.join(firmware_manager.firmware_folder, 'backup')
         backup_path = os.path.join(backup_folder, filename)
         if os.path.exists(backup_path):
             os.remove(backup_path)
+            firmware_manager.hashes.remove(backup_path)
+            firmware_manager.catalog.remove('backup', filename)
             deleted = True
         if deleted:
             return jsonify({'message': 'Firmware deleted successfully'})
@@ -419,24 +620,29 @@ def delete_firmware(filename):
         logger.error(f"Error deleting firmware: {str(e)}")
         return jsonify({'error': 'Failed to delete firmware'}), 500
 
+@app.route('/firmware/catalog/rebuild', methods=['POST'])
+@login_required
+def rebuild_catalog():
+    """Reconcile the firmware catalog with the files on disk"""
+    try:
+        return jsonify(firmware_manager.catalog.rebuild())
+    except Exception as e:
+        logger.error(f"Error rebuilding firmware catalog: {str(e)}")
+        return jsonify({'error': 'Failed to rebuild firmware catalog'}), 500
+
 @app.route('/stats')
 @login_required
 def get_stats():
     """Get server statistics"""
     try:
-        firmware_folder = firmware_manager.firmware_folder
-        backup_folder = os.path.join(firmware_folder, 'backup')
-        
-        total_size = sum(os.path.getsize(os.path.join(firmware_folder, f)) 
-                        for f in os.listdir(firmware_folder) if f.endswith('.bin'))
-        backup_size = sum(os.path.getsize(os.path.join(backup_folder, f)) 
-                         for f in os.listdir(backup_folder) if f.endswith('.bin'))
+        totals = firmware_manager.catalog.totals()
         
         return jsonify({
-            'total_firmware_size': total_size,
-            'backup_size': backup_size,
-            'firmware_count': len([f for f in os.listdir(firmware_folder) if f.endswith('.bin')]),
-            'backup_count': len([f for f in os.listdir(backup_folder) if f.endswith('.bin')]),
+            'total_firmware_size': totals['main']['size'],
+            'backup_size': totals['backup']['size'],
+            'firmware_count': totals['main']['count'],
+            'backup_count': totals['backup']['count'],
+            'hash_index': firmware_manager.hashes.stats(),
             'last_update': datetime.now().isoformat()
         })
     except Exception as e:
@@ -579,15 +785,14 @@ def get_devices_endpoint():
 def api_firmware_list():
     """Return a list of all available firmware files (.bin) with metadata."""
     try:
-        firmware_files = []
-        for file in os.listdir(firmware_manager.firmware_folder):
-            if file.endswith('.bin'):
-                file_path = os.path.join(firmware_manager.firmware_folder, file)
-                firmware_files.append({
-                    'filename': file,
-                    'size': os.path.getsize(file_path),
-                    'last_modified': datetime.fromtimestamp(os.path.getmtime(file_path)).isoformat()
-                })
+        firmware_files = [
+            {
+                'filename': entry['filename'],
+                'size': entry['size'],
+                'last_modified': entry['last_modified']
+            }
+            for entry in firmware_manager.catalog.entries('main')
+        ]
         return jsonify({'firmware': firmware_files})
     except Exception as e:
         logger.error(f"Error listing firmware: {str(e)}")
@@ -595,6 +800,8 @@ def api_firmware_list():
 
 if __name__ == '__main__':
     logger.info("Starting OTA server...")
+    # In the background so a slow index build never delays serving
+    threading.Thread(target=ensure_indexes, daemon=True).start()
     app.run(
         host=config['server']['host'],
         port=config['server']['port'],
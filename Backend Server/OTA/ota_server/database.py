@@ -1,4 +1,5 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING
+from pymongo.errors import PyMongoError
 import os
 from dotenv import load_dotenv
 from datetime import datetime
@@ -23,6 +24,24 @@ except Exception as e:
 
 db = client["smart_home"]
 
+# Indexes the queries below rely on, as (collection, keys, options)
+INDEXES = [
+    ("devices", [("device_id", ASCENDING)], {"name": "device_id_1", "unique": True}),
+]
+
+def ensure_indexes():
+    """Create the indexes in INDEXES; a no-op for those that already exist"""
+    created = 0
+    for collection, keys, options in INDEXES:
+        try:
+            db[collection].create_index(keys, **options)
+            created += 1
+        except PyMongoError as e:
+            # e.g. duplicate device_ids blocking the unique index
+            logger.error(f"Could not create index {collection}.{options['name']}: {str(e)}")
+    logger.info(f"Ensured {created} of {len(INDEXES)} indexes")
+    return created
+
 def register_device(device_id, ip_address, firmware_version, device_info):
     """Register or update a device in the database"""
     try:
@@ -64,4 +64,63 @@ def test_api_key_validation(client):
     # Test with invalid API key
     headers = {'X-API-Key': 'invalid_key'}
     response = client.get('/version', headers=headers)
-    assert response.status_code == 401 
\ No newline at end of file
+    assert response.status_code == 401
+
+
+def test_ensure_indexes_creates_device_index(monkeypatch):
+    mongomock = pytest.importorskip("mongomock")
+    import database
+    monkeypatch.setattr(database, "db", mongomock.MongoClient().db)
+    assert database.ensure_indexes() == 1
+    assert database.db.devices.index_information()["device_id_1"]["unique"]
+    # Running again is a no-op
+    assert database.ensure_indexes() == 1
+
+
+def test_hash_index_reuses_hash_until_file_changes(tmp_path):
+    from app import HashIndex
+    firmware = tmp_path / 'fw.bin'
+    firmware.write_bytes(b'\xE9' + b'a' * 5000)
+    index = HashIndex(str(tmp_path / 'index.json'))
+    first = index.get(str(firmware))
+    assert index.get(str(firmware)) == first
+    assert index.stats() == {'entries': 1, 'hits': 1, 'misses': 1}
+
+    # Loaded from disk by a new instance
+    assert HashIndex(str(tmp_path / 'index.json')).get(str(firmware)) == first
+
+    firmware.write_bytes(b'\xE9' + b'b' * 6000)
+    assert index.get(str(firmware)) != first
+    index.remove(str(firmware))
+    assert index.stats()['entries'] == 0
+
+
+def test_firmware_catalog_tracks_changes_and_rebuilds(tmp_path):
+    from app import HashIndex, FirmwareCatalog
+    main, backup = tmp_path / 'main', tmp_path / 'backup'
+    main.mkdir()
+    backup.mkdir()
+    (main / 'a.bin').write_bytes(b'\xE9a')
+    folders = {'main': str(main), 'backup': str(backup)}
+    manifest = str(tmp_path / 'version.json')
+    catalog = FirmwareCatalog(manifest, folders, HashIndex(str(tmp_path / 'index.json')))
+    assert catalog.latest()['filename'] == 'a.bin'
+
+    (main / 'b.bin').write_bytes(b'\xE9bb')
+    catalog.add('main', 'b.bin')
+    (backup / 'a_1.bin').write_bytes(b'\xE9a')
+    catalog.add('backup', 'a_1.bin')
+    assert catalog.latest()['filename'] == 'b.bin'
+    assert catalog.totals() == {'main': {'count': 2, 'size': 5}, 'backup': {'count': 1, 'size': 2}}
+
+    # Re-adding a file (as restore does) makes it the latest again
+    catalog.add('main', 'a.bin')
+    assert catalog.latest()['filename'] == 'a.bin'
+
+    # The order survives a restart; files removed behind its back are dropped
+    (main / 'b.bin').unlink()
+    reloaded = FirmwareCatalog(manifest, folders, HashIndex(str(tmp_path / 'index.json')))
+    assert [e['filename'] for e in reloaded.entries('main')] == ['a.bin']
+    assert reloaded.latest()['hash'] == catalog.latest()['hash']
+    assert reloaded.remove('main', 'a.bin')
+    assert reloaded.latest() is None
@@ -0,0 +1,230 @@
+"""Sync vs async API throughput benchmark.
+
+Serves the same reads two ways from one uvicorn process: a sync `def`
+handler on pymongo, which Starlette runs in its threadpool (how every route
+worked before), and an `async def` handler on motor (how they work now). A
+separate client process then drives each one at several concurrency levels
+and reports requests/sec and latency percentiles.
+
+    python benchmarks/api_bench.py --mongo-url mongodb://localhost:27017
+    python benchmarks/api_bench.py --mongo-url ... --concurrency 1,32,128 --duration 10 --output api.json
+
+Endpoints:
+    status   one device_states lookup, as in GET /device/status/{device_id} on a cache miss
+    devices  the device list with schedules, as in GET /devices/all
+
+A real MongoDB is required; motor cannot run against mongomock. The data goes
+to the smart_home_bench database, which is dropped first.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_NAME = "smart_home_bench"
+ENDPOINTS = ["status", "devices"]
+MODES = ["sync", "async"]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-url", default=os.getenv("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", default="1,16,64,256")
+    parser.add_argument("--duration", type=float, default=5, help="Seconds per endpoint, mode and concurrency")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def setup_environment(args):
+    # Must run before the app modules are imported
+    sys.path.insert(0, BASE_DIR)
+    os.environ["MONGO_URL"] = args.mongo_url
+    os.environ["MONGO_DB"] = DB_NAME
+    os.environ["MQTT_BROKER"] = "127.0.0.1"
+    os.environ["MQTT_PORT"] = "1"
+
+def seed(db, users, rng):
+    rooms, devices, schedules, states = [], [], [], []
+    for u in range(users):
+        owner = f"user{u}@bench.local"
+        for r in range(2):
+            rooms.append({"owner": owner, "name": f"Room {r}", "description": None})
+            for d in range(2):
+                device_id = f"dev_{u}_{r}_{d}"
+                devices.append({"owner": owner, "room_name": f"Room {r}", "device_id": device_id,
+                                "device_name": "Bench", "added_at": datetime.utcnow()})
+                states.append({"device_id": device_id, "relay": "relay1", "state": rng.choice(["ON", "OFF"]),
+                               "last_updated": datetime.utcnow()})
+                for s in range(2):
+                    schedules.append({"_id": f"s_{device_id}_{s}", "owner": owner, "device_id": device_id,
+                                      "relay": "relay1", "action": "ON", "time": "07:00", "days_of_week": ["Monday"],
+                                      "minute_of_day": 420, "second_of_day": 25200, "timezone": "UTC",
+                                      "created_at": datetime.utcnow()})
+    db.users.insert_many([{"email": f"user{u}@bench.local", "password": "x"} for u in range(users)])
+    db.rooms.insert_many(rooms)
+    db.user_devices.insert_many(devices)
+    db.schedules.insert_many(schedules)
+    db.device_states.insert_many(states)
+
+def build_app():
+    from collections import defaultdict
+    from fastapi import FastAPI, HTTPException
+    from contextlib import asynccontextmanager
+    from pymongo import ASCENDING
+    from database import db, adb, indexes
+    import storage
+    import schedule_index
+
+    @asynccontextmanager
+    async def lifespan(app):
+        adb.connect()
+        yield
+        adb.close()
+
+    app = FastAPI(lifespan=lifespan)
+
+    # The sync handlers issue the same queries the routes used to, on pymongo
+    @app.get("/sync/status/{device_id}")
+    def sync_status(device_id: str):
+        doc = db.device_states.find_one({"device_id": device_id, "state": {"$exists": True}})
+        if doc is None:
+            raise HTTPException(status_code=404, detail="Device not found")
+        return {"device_id": doc["device_id"], "relay": doc["relay"], "state": doc["state"]}
+
+    @app.get("/async/status/{device_id}")
+    async def async_status(device_id: str):
+        doc = await adb.device_states.find_one({"device_id": device_id, "state": {"$exists": True}})
+        if doc is None:
+            raise HTTPException(status_code=404, detail="Device not found")
+        return {"device_id": doc["device_id"], "relay": doc["relay"], "state": doc["state"]}
+
+    @app.get("/sync/devices/{owner}")
+    def sync_devices(owner: str):
+        by_device = defaultdict(list)
+        for doc in db.schedules.find({"owner": owner}).sort([("created_at", ASCENDING), ("_id", ASCENDING)]):
+            by_device[doc["device_id"]].append(schedule_index.schedule_view(doc))
+        result = []
+        for doc in db.user_devices.find({"owner": owner}).sort("_id", ASCENDING):
+            device = storage._device_view(doc, by_device.get(doc["device_id"]))
+            device.update(room_name=doc["room_name"], name=doc.get("device_name") or "")
+            result.append(device)
+        return result
+
+    @app.get("/async/devices/{owner}")
+    async def async_devices(owner: str):
+        return await storage.device_list(owner)
+
+    indexes.ensure()
+    return app
+
+def serve(args):
+    import uvicorn
+    setup_environment(args)
+    uvicorn.run(build_app(), host="127.0.0.1", port=args.port, log_level="warning")
+
+def request_path(endpoint, mode, users, rng):
+    user = rng.randrange(users)
+    if endpoint == "status":
+        return f"/{mode}/status/dev_{user}_{rng.randrange(2)}_{rng.randrange(2)}"
+    return f"/{mode}/devices/user{user}@bench.local"
+
+async def drive(base_url, endpoint, mode, concurrency, duration, users, rng):
+    import httpx
+    latencies, errors = [], 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        deadline = time.perf_counter() + duration
+
+        async def worker():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    response = await client.get(request_path(endpoint, mode, users, rng))
+                    response.raise_for_status()
+                    latencies.append(time.perf_counter() - started)
+                except httpx.HTTPError:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    # Importable once setup_environment has put the app on sys.path
+    from utils.stats import latency_summary
+    return {
+        "endpoint": endpoint,
+        "mode": mode,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "latency_ms": latency_summary(latencies),
+    }
+
+def wait_for_server(base_url, timeout=30):
+    import httpx
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(base_url + "/docs", timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    sys.exit("Benchmark server did not start")
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, text=True).strip()
+    except Exception:
+        return None
+
+def main():
+    args = parse_args()
+    if args.serve:
+        return serve(args)
+    setup_environment(args)
+    import database
+    database.client.drop_database(DB_NAME)
+    seed(database.db, args.users, random.Random(args.seed))
+
+    # The server gets its own process so the load generator does not share its GIL
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", "--port", str(args.port),
+                               "--mongo-url", args.mongo_url])
+    base_url = f"http://127.0.0.1:{args.port}"
+    try:
+        wait_for_server(base_url)
+        rng = random.Random(args.seed)
+        results = []
+        for endpoint in ENDPOINTS:
+            for concurrency in (int(c) for c in args.concurrency.split(",")):
+                for mode in MODES:
+                    results.append(asyncio.run(drive(base_url, endpoint, mode, concurrency, args.duration, args.users, rng)))
+    finally:
+        server.terminate()
+        server.wait()
+
+    report = {
+        "benchmark": "api",
+        "revision": git_revision(),
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+if __name__ == "__main__":
+    main()
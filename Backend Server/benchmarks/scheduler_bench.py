@@ -0,0 +1,253 @@
+"""Scheduler scale benchmark.
+
+Seeds synthetic users with rooms, devices and schedules embedded the old way
+and the same schedules in the schedules collection, loads the scheduler
+cache, then measures one busy tick (a slot many schedules share, like 07:00
+on weekdays) and one idle tick. MQTT publishing is replaced by a counting stub.
+
+    python benchmarks/scheduler_bench.py                       # mongomock, default scales
+    python benchmarks/scheduler_bench.py --scales 1000,10000 --output bench.json
+    python benchmarks/scheduler_bench.py --mongo-url mongodb://localhost:27017 --scales 100000,1000000
+    python benchmarks/scheduler_bench.py --scales 1000 --migrate
+    python benchmarks/scheduler_bench.py --baseline last_release.json
+
+Scales are numbers of schedules. mongomock slows down faster than linearly
+(100000 schedules take minutes to load), so larger scales need --mongo-url.
+With --migrate the schedules collection is filled by migrate_storage
+instead, which also times the migration; keep those scales small. With
+--mongo-url the data goes to the smart_home_bench database, which is
+dropped before each scale. Results are printed as JSON; with --baseline the
+run exits non-zero if any timing regressed by more than --tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+SCHEDULES_PER_DEVICE = 2
+DEVICES_PER_ROOM = 2
+ROOMS_PER_USER = 2
+HOT_TIME = "07:00"
+TIMEZONE = "Asia/Kolkata"
+# Lower is better for every compared metric except throughput
+COMPARED = ["cache_load_seconds", "busy_tick_ms", "idle_tick_ms", "cache_memory_mb"]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="1000,10000")
+    parser.add_argument("--mongo-url", help="Use a real MongoDB instead of mongomock")
+    parser.add_argument("--migrate", action="store_true",
+                        help="Fill the schedules collection by migrating the seeded users")
+    parser.add_argument("--hot-fraction", type=float, default=0.1,
+                        help="Share of schedules due in the busy slot")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Also write the JSON results to this file")
+    parser.add_argument("--baseline", help="Previous results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    return parser.parse_args()
+
+def setup_environment(args):
+    # Must run before the app modules are imported
+    sys.path.insert(0, BASE_DIR)
+    os.environ["MONGO_DB"] = "smart_home_bench"
+    os.environ["MQTT_BROKER"] = "127.0.0.1"
+    os.environ["MQTT_PORT"] = "1"
+    if args.mongo_url:
+        os.environ["MONGO_URL"] = args.mongo_url
+        return
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("mongomock is required without --mongo-url: pip install mongomock")
+    import pymongo
+    shared = mongomock.MongoClient()
+    pymongo.MongoClient = lambda *a, **k: shared
+
+def seed(db, scale, hot_fraction, rng, normalized=True):
+    """Insert the embedded users and, if normalized, their schedules documents."""
+    from schedule_index import schedule_doc
+    per_user = SCHEDULES_PER_DEVICE * DEVICES_PER_ROOM * ROOMS_PER_USER
+    batch, docs, made = [], [], 0
+    for u in range(-(-scale // per_user)):
+        rooms = []
+        for r in range(ROOMS_PER_USER):
+            devices = []
+            for d in range(DEVICES_PER_ROOM):
+                schedules = []
+                for s in range(SCHEDULES_PER_DEVICE):
+                    if made >= scale:
+                        break
+                    hot = rng.random() < hot_fraction
+                    schedules.append({
+                        "schedule_id": f"s{made}",
+                        "action": rng.choice(["ON", "OFF"]),
+                        "time": HOT_TIME if hot else f"{rng.randrange(24):02d}:{rng.randrange(60):02d}",
+                        "days_of_week": DAYS[:5] if hot else rng.sample(DAYS, rng.randint(1, 7)),
+                        "relay": f"relay{s + 1}",
+                    })
+                    made += 1
+                devices.append({"device_id": f"dev_{u}_{r}_{d}", "device_name": "Bench", "schedules": schedules})
+                if normalized:
+                    docs += [schedule_doc(f"user{u}@bench.local", f"dev_{u}_{r}_{d}", s, TIMEZONE) for s in schedules]
+            rooms.append({"name": f"Room {r}", "devices": devices})
+        batch.append({"email": f"user{u}@bench.local", "password": "x", "timezone": TIMEZONE, "rooms": rooms})
+        if len(batch) == 1000:
+            db.users.insert_many(batch)
+            batch = []
+        if len(docs) >= 10000:
+            db.schedules.insert_many(docs)
+            docs = []
+    if batch:
+        db.users.insert_many(batch)
+    if docs:
+        db.schedules.insert_many(docs)
+    return -(-scale // per_user)
+
+def next_hot_slot():
+    import pytz
+    tz = pytz.timezone(TIMEZONE)
+    day = datetime.now(tz).date() + timedelta(days=1)
+    while day.strftime("%A") not in DAYS[:5]:
+        day += timedelta(days=1)
+    hours, minutes = map(int, HOT_TIME.split(":"))
+    return tz.localize(datetime(day.year, day.month, day.day, hours, minutes)).timestamp()
+
+def full_scan_ms(db):
+    # The original per-minute algorithm: walk every user document
+    started = time.perf_counter()
+    matched = 0
+    for user in db.users.find({}):
+        for room in user.get("rooms", []):
+            for device in room.get("devices", []):
+                for schedule in device.get("schedules", []):
+                    if schedule["time"] == HOT_TIME and "Monday" in schedule["days_of_week"]:
+                        matched += 1
+    return round((time.perf_counter() - started) * 1000, 3)
+
+def run_scale(scale, args):
+    import database
+    import scheduler
+    import migrate_storage
+    from leases import lease_manager
+
+    database.client.drop_database("smart_home_bench")
+    rng = random.Random(args.seed)
+    published = []
+
+    def fake_publish(topic, msg, **kwargs):
+        published.append(topic)
+        delivery = Future()
+        delivery.set_result(0.0)
+        return delivery
+    scheduler.publish = fake_publish
+
+    started = time.perf_counter()
+    users = seed(database.db, scale, args.hot_fraction, rng, normalized=not args.migrate)
+    seed_seconds = time.perf_counter() - started
+
+    # The original per-minute algorithm only works on the embedded layout
+    full_scan_tick_ms = full_scan_ms(database.db)
+
+    migration_seconds = None
+    if args.migrate:
+        started = time.perf_counter()
+        migrate_storage.migrate_all(batch_size=1000)
+        migration_seconds = round(time.perf_counter() - started, 3)
+
+    lease_manager.start()
+    tracemalloc.start()
+    started = time.perf_counter()
+    scheduler._on_shards_changed(lease_manager.held(), set())
+    cache_load_seconds = time.perf_counter() - started
+    cache_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    hot_at = next_hot_slot()
+    # Everything before the hot slot is skipped as outside the catch-up window
+    scheduler.check_and_execute_schedules(now=hot_at - scheduler.CATCHUP_SECONDS - 1)
+    published.clear()
+
+    started = time.perf_counter()
+    scheduler.check_and_execute_schedules(now=hot_at)
+    busy_tick = time.perf_counter() - started
+    due = len(published)
+    dispatch_seconds = scheduler.last_tick.get("dispatch_seconds") or busy_tick
+
+    started = time.perf_counter()
+    scheduler.check_and_execute_schedules(now=hot_at + 1)
+    idle_tick = time.perf_counter() - started
+
+    scheduler._on_shards_changed(set(), lease_manager.held())
+    return {
+        "scale": scale,
+        "users": users,
+        "seed_seconds": round(seed_seconds, 3),
+        "migration_seconds": migration_seconds,
+        "cache_load_seconds": round(cache_load_seconds, 3),
+        "cache_memory_mb": round(cache_bytes / 1024 / 1024, 2),
+        "due_in_busy_tick": due,
+        "busy_tick_ms": round(busy_tick * 1000, 3),
+        "idle_tick_ms": round(idle_tick * 1000, 3),
+        "publishes_per_second": round(due / dispatch_seconds, 1) if dispatch_seconds else None,
+        "full_scan_tick_ms": full_scan_tick_ms,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def compare(results, baseline, tolerance):
+    previous = {r["scale"]: r for r in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        old = previous.get(result["scale"])
+        if not old:
+            continue
+        for metric in COMPARED:
+            if old.get(metric) and result[metric] > old[metric] * (1 + tolerance):
+                regressions.append({"scale": result["scale"], "metric": metric,
+                                    "baseline": old[metric], "current": result[metric]})
+        if old.get("publishes_per_second") and result["publishes_per_second"] is not None \
+                and result["publishes_per_second"] < old["publishes_per_second"] * (1 - tolerance):
+            regressions.append({"scale": result["scale"], "metric": "publishes_per_second",
+                                "baseline": old["publishes_per_second"], "current": result["publishes_per_second"]})
+    return regressions
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, text=True).strip()
+    except Exception:
+        return None
+
+def main():
+    args = parse_args()
+    setup_environment(args)
+    results = [run_scale(int(scale), args) for scale in args.scales.split(",")]
+    report = {
+        "benchmark": "scheduler",
+        "revision": git_revision(),
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "backend": "mongodb" if args.mongo_url else "mongomock",
+        "results": results,
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(results, json.load(f), args.tolerance)
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    if report.get("regressions"):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+from collections import OrderedDict
+import threading
+import time
+
+class LRUCache:
+    """Thread-safe LRU cache with hit, miss and eviction counters.
+
+    Entries can optionally expire, either after a cache-wide ttl or at a
+    per-entry expires_at (a time.time() timestamp).
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > time.time()):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def peek(self, key, default=None):
+        """Like get, but leaves recency and the hit/miss counters alone."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > time.time()):
+                return entry[0]
+            return default
+
+    def _expiry(self, expires_at):
+        if expires_at is not None:
+            return expires_at
+        return time.time() + self.ttl if self.ttl else None
+
+    def _insert(self, key, value, expires_at):
+        self._data[key] = (value, self._expiry(expires_at))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def put(self, key, value, expires_at=None):
+        with self._lock:
+            self._insert(key, value, expires_at)
+
+    def add(self, key, value, expires_at=None):
+        """Store value unless the key was filled in the meantime, e.g. by a newer write."""
+        with self._lock:
+            if key in self._data:
+                return False
+            self._insert(key, value, expires_at)
+            return True
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def invalidate_where(self, predicate):
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
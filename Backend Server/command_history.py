@@ -0,0 +1,153 @@
+from datetime import datetime, timedelta
+from collections import defaultdict
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import CollectionInvalid, OperationFailure, PyMongoError
+import threading
+import logging
+import time
+import os
+from database import db, adb, indexes
+from leases import try_acquire
+
+logger = logging.getLogger(__name__)
+
+RETENTION_DAYS = int(os.getenv("COMMAND_LOG_RETENTION_DAYS", "30"))
+ROLLUP_RETENTION_DAYS = int(os.getenv("COMMAND_ROLLUP_RETENTION_DAYS", "365"))
+ROLLUP_INTERVAL_SECONDS = int(os.getenv("COMMAND_ROLLUP_INTERVAL_SECONDS", "300"))
+# An hour is only rolled up once buffered command logs have had time to land
+ROLLUP_DELAY_SECONDS = int(os.getenv("COMMAND_ROLLUP_DELAY_SECONDS", "120"))
+ROLLUP_LEASE = "rollup:command_logs"
+CHECKPOINT_ID = "rollup:command_logs"
+HOUR = timedelta(hours=1)
+
+command_logs = db.command_logs
+# One document per device and hour: total, per action and per source counts
+rollups = db.command_rollups
+
+indexes.declare("command_rollups", ["device_id", "hour"], unique=True)
+indexes.declare("command_rollups", ["hour"], expireAfterSeconds=ROLLUP_RETENTION_DAYS * 86400)
+
+def setup_command_logs():
+    """Make command_logs a time-series collection that expires after the retention period.
+
+    Servers without time-series support, or a command_logs collection that
+    already exists as a regular one, get a TTL index on timestamp instead.
+    Returns the storage mode in use.
+    """
+    retention = RETENTION_DAYS * 86400
+    try:
+        db.create_collection(
+            "command_logs",
+            timeseries={"timeField": "timestamp", "metaField": "device_id", "granularity": "seconds"},
+            expireAfterSeconds=retention,
+        )
+        logger.info(f"Created command_logs as a time-series collection with {RETENTION_DAYS} day retention")
+        return "timeseries"
+    except CollectionInvalid:
+        pass
+    except OperationFailure as e:
+        logger.warning(f"Time-series collections unavailable, using a TTL index for command_logs: {str(e)}")
+
+    options = command_logs.options()
+    if "timeseries" in options:
+        if options.get("expireAfterSeconds") != retention:
+            db.command("collMod", "command_logs", expireAfterSeconds=retention)
+        return "timeseries"
+    try:
+        command_logs.create_index([("timestamp", ASCENDING)], name="timestamp_ttl", expireAfterSeconds=retention)
+    except OperationFailure:
+        # The index exists with an older retention period
+        db.command("collMod", "command_logs", index={"name": "timestamp_ttl", "expireAfterSeconds": retention})
+    return "ttl"
+
+def _hour(when):
+    return when.replace(minute=0, second=0, microsecond=0)
+
+def rollup_hour(start):
+    """Count the commands logged in the hour starting at start, per device.
+
+    Counts are $set rather than $inc, so rolling up an hour again is harmless.
+    """
+    pipeline = [
+        {"$match": {"timestamp": {"$gte": start, "$lt": start + HOUR}}},
+        {"$group": {"_id": {"device_id": "$device_id", "action": "$action", "source": "$source"}, "count": {"$sum": 1}}},
+    ]
+    per_device = defaultdict(lambda: {"count": 0, "actions": defaultdict(int), "sources": defaultdict(int)})
+    for row in command_logs.aggregate(pipeline):
+        counts = per_device[row["_id"]["device_id"]]
+        counts["count"] += row["count"]
+        counts["actions"][str(row["_id"].get("action"))] += row["count"]
+        counts["sources"][str(row["_id"].get("source"))] += row["count"]
+    ops = [
+        UpdateOne(
+            {"device_id": device_id, "hour": start},
+            {"$set": {"count": c["count"], "actions": dict(c["actions"]), "sources": dict(c["sources"])}},
+            upsert=True,
+        )
+        for device_id, c in per_device.items()
+    ]
+    if ops:
+        rollups.bulk_write(ops, ordered=False)
+    return len(ops)
+
+def _first_hour():
+    state = db.scheduler_state.find_one({"_id": CHECKPOINT_ID})
+    if state:
+        return state["rolled_up_until"]
+    oldest = command_logs.find_one({}, {"timestamp": 1}, sort=[("timestamp", ASCENDING)])
+    return _hour(oldest["timestamp"]) if oldest else None
+
+def run_rollups(now=None):
+    """Roll up every complete hour since the last checkpoint and return how many were done.
+
+    Only the node holding the rollup lease does any work.
+    """
+    if not try_acquire(ROLLUP_LEASE):
+        return 0
+    end = _hour((now or datetime.utcnow()) - timedelta(seconds=ROLLUP_DELAY_SECONDS))
+    start = _first_hour()
+    if start is None:
+        return 0
+    done = 0
+    while start < end:
+        # Renewing per hour keeps a long catch-up from outliving the lease
+        if done and not try_acquire(ROLLUP_LEASE):
+            break
+        devices = rollup_hour(start)
+        start += HOUR
+        db.scheduler_state.update_one({"_id": CHECKPOINT_ID}, {"$set": {"rolled_up_until": start}}, upsert=True)
+        logger.debug(f"Rolled up {devices} devices for the hour before {start}")
+        done += 1
+    if done:
+        logger.info(f"Rolled up {done} hours of command logs")
+    return done
+
+def _run_rollups():
+    while True:
+        try:
+            run_rollups()
+        except PyMongoError as e:
+            logger.error(f"Error rolling up command logs: {str(e)}")
+        time.sleep(ROLLUP_INTERVAL_SECONDS)
+
+async def device_history(device_id, start, end, bucket="hour"):
+    """Command counts for a device from the hourly rollups, optionally summed per day."""
+    buckets = {}
+    query = {"device_id": device_id, "hour": {"$gte": start, "$lt": end}}
+    async for doc in adb.command_rollups.find(query).sort("hour", ASCENDING):
+        key = doc["hour"] if bucket == "hour" else doc["hour"].replace(hour=0)
+        entry = buckets.setdefault(key, {"start": key, "count": 0, "actions": defaultdict(int), "sources": defaultdict(int)})
+        entry["count"] += doc["count"]
+        for action, n in doc.get("actions", {}).items():
+            entry["actions"][action] += n
+        for source, n in doc.get("sources", {}).items():
+            entry["sources"][source] += n
+    return [{**b, "actions": dict(b["actions"]), "sources": dict(b["sources"])} for b in buckets.values()]
+
+def start_command_history():
+    try:
+        mode = setup_command_logs()
+        logger.info(f"command_logs retention: {RETENTION_DAYS} days ({mode})")
+    except PyMongoError as e:
+        logger.error(f"Error setting up command_logs retention: {str(e)}")
+    threading.Thread(target=_run_rollups, daemon=True).start()
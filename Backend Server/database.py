@@ -1,7 +1,54 @@
 from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
 import os
 from dotenv import load_dotenv
+from utils.index_manager import IndexManager
 
 load_dotenv()
-client = MongoClient(os.getenv("MONGO_URL"))
-db = client["smart_home"]
\ No newline at end of file
+
+MONGO_URL = os.getenv("MONGO_URL")
+DB_NAME = os.getenv("MONGO_DB", "smart_home")
+# Shared by the sync client (background workers) and the async client (routes)
+POOL_OPTIONS = {
+    "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+    "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+    "maxIdleTimeMS": int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000")),
+    "waitQueueTimeoutMS": int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000")),
+    "serverSelectionTimeoutMS": int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+}
+
+client = MongoClient(MONGO_URL, **POOL_OPTIONS)
+db = client[DB_NAME]
+
+class AsyncDatabase:
+    """Motor database used by the request handlers.
+
+    The client is bound to the event loop it is first used on, so it is opened
+    and closed by the app lifespan rather than at import.
+    """
+
+    def __init__(self):
+        self.client = None
+
+    def connect(self):
+        if self.client is None:
+            self.client = AsyncIOMotorClient(MONGO_URL, **POOL_OPTIONS)
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    def __getattr__(self, name):
+        if self.client is None:
+            raise RuntimeError("Async database used before the app started")
+        return self.client[DB_NAME][name]
+
+adb = AsyncDatabase()
+
+# Other modules declare indexes for their own collections; main.py creates them
+indexes = IndexManager(db)
+indexes.declare("users", ["email"], unique=True)
+indexes.declare("device_states", ["device_id", "relay"], unique=True)
+indexes.declare("device_telemetry", ["device_id"], unique=True)
+indexes.declare("command_logs", ["device_id", "timestamp"])
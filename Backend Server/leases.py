@@ -0,0 +1,150 @@
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from uuid import uuid4
+import threading
+import hashlib
+import logging
+import atexit
+import socket
+import time
+import os
+from database import db, indexes
+
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = int(os.getenv("SCHEDULER_LEASE_SECONDS", "10"))
+RENEW_SECONDS = LEASE_SECONDS / 3
+SHARD_COUNT = int(os.getenv("SCHEDULER_SHARDS", "1"))
+MAX_SHARDS_PER_NODE = int(os.getenv("SCHEDULER_MAX_SHARDS_PER_NODE", str(SHARD_COUNT)))
+NODE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+
+leases = db.scheduler_leases
+# Expired leases are also reaped by Mongo in case a node never comes back
+indexes.declare("scheduler_leases", ["expires_at"], expireAfterSeconds=LEASE_SECONDS)
+
+def shard_of(owner):
+    """Stable shard for a user, identical across processes."""
+    return int(hashlib.md5(owner.encode()).hexdigest(), 16) % SHARD_COUNT
+
+def backfill_shards(collection):
+    """Store `shard` on documents written without it or under another SCHEDULER_SHARDS.
+
+    Engines load their documents with a {"shard": {"$in": held}} query, so the
+    stored value has to match shard_of for the current shard count.
+    """
+    state_id = f"shards:{collection.name}"
+    try:
+        state = db.scheduler_state.find_one({"_id": state_id}) or {}
+        query = {"shard": None} if state.get("count") == SHARD_COUNT else {}
+        owners = collection.distinct("owner", query)
+        for owner in owners:
+            collection.update_many({**query, "owner": owner}, {"$set": {"shard": shard_of(owner)}})
+        db.scheduler_state.update_one({"_id": state_id}, {"$set": {"count": SHARD_COUNT}}, upsert=True)
+    except PyMongoError as e:
+        logger.error(f"Error backfilling shards for {collection.name}: {str(e)}")
+        return
+    if owners:
+        logger.info(f"Set shard on {collection.name} for {len(owners)} owners")
+
+def _lease_name(shard):
+    return f"shard:{shard}"
+
+def try_acquire(name):
+    now = datetime.utcnow()
+    try:
+        leases.find_one_and_update(
+            {"_id": name, "$or": [{"holder": NODE_ID}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"holder": NODE_ID, "expires_at": now + timedelta(seconds=LEASE_SECONDS)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return True
+    except DuplicateKeyError:
+        # Another node holds an unexpired lease
+        return False
+
+def release(name):
+    leases.delete_one({"_id": name, "holder": NODE_ID})
+
+class LeaseManager:
+    """Holds scheduler shard leases for this process and renews them in the background.
+
+    A shard is only considered held until its local deadline, which is set a
+    renew interval short of the lease expiry, so a node that cannot reach Mongo
+    stops firing before another node can take over.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._deadlines = {}  # shard -> local time the lease is trusted until
+        self._listeners = []
+        self._started = False
+
+    def add_listener(self, callback):
+        """callback(acquired, lost) is called with sets of shards whenever ownership changes."""
+        self._listeners.append(callback)
+
+    def held(self):
+        now = time.time()
+        with self._lock:
+            return {shard for shard, deadline in self._deadlines.items() if deadline > now}
+
+    def owns(self, owner):
+        shard = shard_of(owner)
+        with self._lock:
+            return self._deadlines.get(shard, 0) > time.time()
+
+    def _renew_once(self):
+        before = self.held()
+        for shard in range(SHARD_COUNT):
+            if shard not in before and len(self.held()) >= MAX_SHARDS_PER_NODE:
+                continue
+            started = time.time()
+            try:
+                acquired = try_acquire(_lease_name(shard))
+            except PyMongoError as e:
+                logger.error(f"Error renewing lease for shard {shard}: {str(e)}")
+                continue
+            with self._lock:
+                if acquired:
+                    self._deadlines[shard] = started + LEASE_SECONDS - RENEW_SECONDS
+                else:
+                    self._deadlines.pop(shard, None)
+        after = self.held()
+        acquired, lost = after - before, before - after
+        if acquired or lost:
+            logger.info(f"Node {NODE_ID} shards: +{sorted(acquired)} -{sorted(lost)}")
+            for callback in self._listeners:
+                try:
+                    callback(acquired, lost)
+                except Exception as e:
+                    logger.error(f"Lease listener failed: {str(e)}")
+
+    def _run(self):
+        while True:
+            self._renew_once()
+            time.sleep(RENEW_SECONDS)
+
+    def release_all(self):
+        for shard in self.held():
+            try:
+                release(_lease_name(shard))
+            except PyMongoError:
+                pass
+        with self._lock:
+            self._deadlines.clear()
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        self._renew_once()
+        threading.Thread(target=self._run, daemon=True).start()
+        # Hand shards over immediately on a clean shutdown
+        atexit.register(self.release_all)
+
+    def stats(self):
+        return {"node_id": NODE_ID, "shard_count": SHARD_COUNT, "held_shards": sorted(self.held())}
+
+lease_manager = LeaseManager()
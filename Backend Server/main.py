@@ -1,15 +1,34 @@
 from fastapi import FastAPI
+from contextlib import asynccontextmanager
 from routes import auth, device, ota
 from routes import room  # Import the new room router
+from routes import metrics, timer, live
 import mqtt_client # ensures MQTT starts
+import state_store
 import socket
 import qrcode
 from qrcode.constants import ERROR_CORRECT_L
 import io
 from PIL import Image
 from scheduler import start_scheduler
+from timers import start_timers
+from database import adb, indexes
+from command_history import start_command_history
+from migrate_storage import start_migration
+from utils.hash import shutdown_pool
+from ota_client import ota_client
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    adb.connect()
+    ota_client.start()
+    yield
+    await ota_client.close()
+    state_store.flush_all()
+    shutdown_pool()
+    adb.close()
+
+app = FastAPI(lifespan=lifespan)
 
 def get_local_ip():
     try:
@@ -26,6 +45,17 @@ app.include_router(auth.router)
 app.include_router(device.router)
 app.include_router(ota.router)
 app.include_router(room.router)  # Register the room router
+app.include_router(timer.router)
+app.include_router(metrics.router)
+app.include_router(live.router)
 
 # Start the background scheduler for device schedules
-start_scheduler()
\ No newline at end of file
+start_scheduler()
+start_timers()
+# Before the index bootstrap, which would create command_logs as a regular collection
+start_command_history()
+
+# Every module has declared its indexes by now
+indexes.ensure_in_background()
+# Users still holding embedded rooms; their schedules only fire once moved
+start_migration()
\ No newline at end of file
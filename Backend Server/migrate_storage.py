@@ -0,0 +1,88 @@
+"""Move rooms, devices and schedules out of user documents.
+
+Runs online: the API keeps serving while users are migrated one at a time,
+and any user touched through the API in the meantime is migrated on the spot.
+The API server also starts it in the background on startup (start_migration).
+Progress is checkpointed in the migrations collection, so an interrupted run
+picks up after the last finished batch.
+
+    python migrate_storage.py
+    python migrate_storage.py --batch-size 200 --pause 0.5
+    python migrate_storage.py --restart      # ignore the checkpoint
+"""
+from datetime import datetime
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
+import argparse
+import logging
+import threading
+import time
+from database import db, indexes
+import storage
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_ID = "normalize_rooms"
+
+def _checkpoint(**fields):
+    db.migrations.update_one({"_id": MIGRATION_ID}, {"$set": {**fields, "updated_at": datetime.utcnow()}}, upsert=True)
+
+def migrate_all(batch_size=500, pause=0, restart=False):
+    """Migrate every user that still has embedded rooms and return how many were moved."""
+    indexes.ensure()
+    state = db.migrations.find_one({"_id": MIGRATION_ID})
+    # Resume an unfinished run; anything else starts a new one
+    if restart or not state or state.get("finished_at"):
+        state = {}
+        _checkpoint(started_at=datetime.utcnow(), finished_at=None, last_user_id=None, migrated=0, failed=0)
+    last_id = state.get("last_user_id")
+    migrated = state.get("migrated", 0)
+    failed = state.get("failed", 0)
+    while True:
+        query = {"rooms": {"$exists": True}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = list(db.users.find(query, {"email": 1}).sort("_id", ASCENDING).limit(batch_size))
+        if not batch:
+            break
+        for user in batch:
+            try:
+                migrated += storage.migrate_user(user["email"])
+            except PyMongoError as e:
+                # Left in place; the user is migrated on next access or next run
+                failed += 1
+                logger.error(f"Error migrating {user['email']}: {str(e)}")
+        last_id = batch[-1]["_id"]
+        _checkpoint(last_user_id=last_id, migrated=migrated, failed=failed)
+        logger.info(f"Migrated {migrated} users so far")
+        if pause:
+            time.sleep(pause)
+    _checkpoint(last_user_id=last_id, migrated=migrated, failed=failed, finished_at=datetime.utcnow())
+    logger.info(f"Migration finished: {migrated} users migrated, {failed} failed")
+    return migrated
+
+def start_migration():
+    """Migrate remaining users in the background so their schedules keep firing.
+
+    The scheduler only reads the schedules collection; without this an
+    embedded schedule would wait for its owner's next API call.
+    """
+    def run():
+        try:
+            if db.users.find_one({"rooms": {"$exists": True}}, {"_id": 1}) is not None:
+                migrate_all()
+        except PyMongoError as e:
+            logger.error(f"Background migration failed, run migrate_storage.py: {str(e)}")
+    threading.Thread(target=run, name="storage-migration", daemon=True).start()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--pause", type=float, default=0, help="Seconds to sleep between batches")
+    parser.add_argument("--restart", action="store_true", help="Start from the first user again")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    migrate_all(args.batch_size, args.pause, args.restart)
+
+if __name__ == "__main__":
+    main()
@@ -12,11 +12,21 @@ class UserLogin(BaseModel):
     email: EmailStr
     password: str
 
+class UserTimezone(BaseModel):
+    timezone: str  # IANA name, e.g. "Europe/Berlin"
+
 class DeviceControl(BaseModel):
     device_id: str
     relay: str
     action: str  # "ON" or "OFF"
 
+class BatchControl(BaseModel):
+    commands: List[DeviceControl] = []
+    # Or switch a whole room: every device in it gets action on each relay
+    room_name: Optional[str] = None
+    action: Optional[str] = None  # "ON" or "OFF", with room_name
+    relays: Optional[List[str]] = None  # Defaults to every relay the devices have reported
+
 class OTAUpdateCheck(BaseModel):
     device_id: str
     current_version: str
@@ -64,6 +74,7 @@ class DeviceRegister(BaseModel):
 
 class DeviceSchedule(BaseModel):
     action: str  # "ON" or "OFF"
-    time: str    # "HH:MM" 24-hour format
+    time: str    # "HH:MM" or "HH:MM:SS" 24-hour format, in the user's timezone
     days_of_week: List[str]  # e.g., ["Monday", "Wednesday"]
+    relay: Optional[str] = None  # Relay to switch, e.g. "led1"
     schedule_id: Optional[str] = None  # For updates
\ No newline at end of file
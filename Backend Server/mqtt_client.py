@@ -1,7 +1,16 @@
 import paho.mqtt.client as mqtt
 import os
 from dotenv import load_dotenv
+from collections import deque
+from datetime import datetime
+from concurrent.futures import Future
+import threading
 import logging
+import queue
+import json
+import time
+import state_store
+from utils.stats import latency_summary
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -9,33 +18,246 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+OUTBOUND_QUEUE_SIZE = int(os.getenv("MQTT_OUTBOUND_QUEUE_SIZE", "10000"))
+DEFAULT_QOS = int(os.getenv("MQTT_QOS", "1"))
+# Messages still queued after this long are dropped rather than sent late
+MESSAGE_TTL_SECONDS = float(os.getenv("MQTT_MESSAGE_TTL_SECONDS", "60"))
+LATENCY_SAMPLES = 1000
+
+# What devices report back: relay state as ON/OFF, telemetry as JSON
+STATE_TOPIC = "device/+/+/state"
+TELEMETRY_TOPIC = "device/+/telemetry"
+# Commands sent to relays, by any worker, the scheduler or timers
+COMMAND_TOPIC = "device/+/+/set"
+# With several workers, set MQTT_SHARE_GROUP (e.g. smart-home-ingest) so they
+# subscribe as one shared group and each report is ingested once, not once per
+# worker. Off by default: a broker without $share support would deliver nothing.
+SHARE_GROUP = os.getenv("MQTT_SHARE_GROUP", "")
+RELAY_STATES = {"ON", "OFF"}
+
 mqtt_client = mqtt.Client()
 
+class PublishQueueFull(Exception):
+    """Raised when the outbound queue is full and the message was not accepted."""
+
+class MessageExpired(Exception):
+    """Set on a message's future when it sat in the queue past its TTL."""
+
+class OutboundMessage:
+    def __init__(self, topic, payload, qos):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        self.expires_at = self.enqueued_at + MESSAGE_TTL_SECONDS
+
+outbound = queue.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+connected = threading.Event()
+_inflight = {}  # mid -> OutboundMessage awaiting on_publish
+_completed = set()  # mids acknowledged before _drain_outbound registered them
+# Never held while calling into paho: on_publish runs under paho's own mutex
+_inflight_lock = threading.Lock()
+_latencies = deque(maxlen=LATENCY_SAMPLES)
+counters = {"enqueued": 0, "published": 0, "failed": 0, "dropped": 0, "cancelled": 0, "expired": 0}
+
+def _subscription(topic):
+    return f"$share/{SHARE_GROUP}/{topic}" if SHARE_GROUP else topic
+
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         logger.info("Connected to MQTT Broker successfully")
+        # Subscribe on every connect so subscriptions survive reconnects
+        client.subscribe([(_subscription(STATE_TOPIC), 0), (_subscription(TELEMETRY_TOPIC), 0)])
+        connected.set()
     else:
         logger.error(f"Failed to connect to MQTT Broker, return code: {rc}")
 
+def on_subscribe(client, userdata, mid, granted_qos):
+    # 0x80 in the SUBACK means the broker refused the subscription
+    if any(qos == 0x80 for qos in granted_qos):
+        hint = " (does the broker support $share? unset MQTT_SHARE_GROUP)" if SHARE_GROUP else ""
+        logger.error(f"MQTT broker refused the ingestion subscriptions{hint}; device reports will not be received")
+
 def on_disconnect(client, userdata, rc):
+    connected.clear()
     logger.warning(f"Disconnected from MQTT Broker with code: {rc}")
 
+def _complete(message):
+    latency = time.monotonic() - message.enqueued_at
+    _latencies.append(latency)
+    counters["published"] += 1
+    # Runs on paho's network thread: raising here would stop the network loop
+    if not message.future.done():
+        message.future.set_result(latency)
+
+def on_publish(client, userdata, mid):
+    with _inflight_lock:
+        message = _inflight.pop(mid, None)
+        if message is None:
+            # Acknowledged before publish() returned its mid to the drain thread
+            _completed.add(mid)
+            return
+    _complete(message)
+
+def _track(mid, message):
+    with _inflight_lock:
+        if mid in _completed:
+            _completed.discard(mid)
+        else:
+            _inflight[mid] = message
+            return
+    _complete(message)
+
+def on_message(client, userdata, message):
+    parts = message.topic.split("/")
+    payload = message.payload.decode(errors="replace").strip()
+    try:
+        if len(parts) == 4 and parts[3] == "state":
+            # Anything other than ON/OFF (e.g. BOOTED) only marks the device as seen
+            state = payload.upper() if payload.upper() in RELAY_STATES else None
+            state_store.record_state(parts[1], parts[2], state, "device")
+        elif len(parts) == 3 and parts[2] == "telemetry":
+            state_store.record_telemetry(parts[1], json.loads(payload))
+    except ValueError:
+        logger.warning(f"Ignoring malformed message on {message.topic}")
+
 mqtt_client.on_connect = on_connect
 mqtt_client.on_disconnect = on_disconnect
+mqtt_client.on_publish = on_publish
+mqtt_client.on_subscribe = on_subscribe
+mqtt_client.on_message = on_message
+
+def _mark_disconnected():
+    connected.clear()
+    # on_connect may have fired since publish() saw the connection down
+    if mqtt_client.is_connected():
+        connected.set()
+
+def _drain_outbound():
+    while True:
+        message = outbound.get()
+        while True:
+            # Hold messages while the broker is unreachable instead of dropping them
+            connected.wait()
+            # The caller stopped waiting (e.g. a timed out request); don't send it at all.
+            # Once running the future can no longer be cancelled.
+            if not message.future.running() and not message.future.set_running_or_notify_cancel():
+                counters["cancelled"] += 1
+                break
+            if time.monotonic() >= message.expires_at:
+                # A command that arrives minutes late is worse than none
+                logger.warning(f"Dropping message to {message.topic} queued for over {MESSAGE_TTL_SECONDS}s")
+                counters["expired"] += 1
+                message.future.set_exception(MessageExpired(f"Not sent within {MESSAGE_TTL_SECONDS}s"))
+                break
+            try:
+                info = mqtt_client.publish(message.topic, message.payload, qos=message.qos)
+                if info.rc == mqtt.MQTT_ERR_SUCCESS or (info.rc == mqtt.MQTT_ERR_NO_CONN and message.qos > 0):
+                    # At QoS 1+ paho keeps an unsent message and resends it on
+                    # reconnect under the same mid, so it is tracked, not republished
+                    _track(info.mid, message)
+                    if info.rc == mqtt.MQTT_ERR_NO_CONN:
+                        # Hold the rest in our bounded queue until the broker is back
+                        _mark_disconnected()
+                    break
+                if info.rc != mqtt.MQTT_ERR_NO_CONN:
+                    raise RuntimeError(mqtt.error_string(info.rc))
+                _mark_disconnected()
+            except Exception as e:
+                logger.error(f"Failed to publish message to {message.topic}: {str(e)}")
+                counters["failed"] += 1
+                if not message.future.done():
+                    message.future.set_exception(e)
+                break
 
 try:
     broker = os.getenv("MQTT_BROKER")
     port = int(os.getenv("MQTT_PORT"))
     logger.info(f"Attempting to connect to MQTT Broker at {broker}:{port}")
-    mqtt_client.connect(broker, port)
+    # The network loop keeps retrying in the background if the broker is down
+    mqtt_client.connect_async(broker, port)
     mqtt_client.loop_start()
 except Exception as e:
     logger.error(f"Error connecting to MQTT Broker: {str(e)}")
 
-def publish(topic, msg):
+threading.Thread(target=_drain_outbound, daemon=True).start()
+state_store.start()
+
+_state_feed = None
+_state_feed_lock = threading.Lock()
+_state_listeners = []
+
+def start_state_feed(callback):
+    """Call callback(device_id, relay, state, when, source) for every relay state change.
+
+    Uses its own connection with plain subscriptions: a worker serving live
+    updates or caching states must see every report and command, not just
+    those the shared ingestion group routed to it. The connection is opened on
+    the first call; later calls add listeners to it.
+    """
+    global _state_feed
+    with _state_feed_lock:
+        if callback not in _state_listeners:
+            _state_listeners.append(callback)
+        if _state_feed is not None:
+            return
+        _state_feed = mqtt.Client()
+
+    def on_feed_connect(client, userdata, flags, rc):
+        if rc == 0:
+            client.subscribe([(STATE_TOPIC, 0), (COMMAND_TOPIC, 0)])
+
+    def on_feed_message(client, userdata, message):
+        parts = message.topic.split("/")
+        state = message.payload.decode(errors="replace").strip().upper()
+        if len(parts) == 4 and state in RELAY_STATES:
+            source = "device" if parts[3] == "state" else "command"
+            when = datetime.utcnow()
+            for listener in list(_state_listeners):
+                try:
+                    listener(parts[1], parts[2], state, when, source)
+                except Exception as e:
+                    # Raising here would stop the feed's network loop
+                    logger.error(f"State feed listener failed: {str(e)}")
+
+    _state_feed.on_connect = on_feed_connect
+    _state_feed.on_message = on_feed_message
     try:
-        result = mqtt_client.publish(topic, msg)
-        if result.rc != 0:
-            logger.error(f"Failed to publish message to {topic}")
+        _state_feed.connect_async(os.getenv("MQTT_BROKER"), int(os.getenv("MQTT_PORT")))
+        _state_feed.loop_start()
     except Exception as e:
-        logger.error(f"Error publishing message: {str(e)}")
\ No newline at end of file
+        logger.error(f"Error starting the MQTT state feed: {str(e)}")
+
+# Keeps every worker's status cache current, whichever worker ingested the report
+start_state_feed(state_store.apply_feed)
+
+def publish(topic, msg, qos=None):
+    """Queue a message for delivery and return a Future resolved once the broker has it.
+
+    The future's result is the delivery latency in seconds. Cancelling it before
+    the message leaves the queue withdraws the message; one not sent within
+    MESSAGE_TTL_SECONDS fails with MessageExpired. Raises PublishQueueFull
+    without queueing when the outbound queue is at capacity.
+    """
+    message = OutboundMessage(topic, msg, DEFAULT_QOS if qos is None else qos)
+    try:
+        outbound.put_nowait(message)
+    except queue.Full:
+        counters["dropped"] += 1
+        logger.error(f"Outbound MQTT queue full, dropping message to {topic}")
+        raise PublishQueueFull(f"Outbound MQTT queue is full ({OUTBOUND_QUEUE_SIZE} messages)")
+    counters["enqueued"] += 1
+    return message.future
+
+def get_stats():
+    with _inflight_lock:
+        inflight = len(_inflight)
+    return {
+        "connected": connected.is_set(),
+        "queue_depth": outbound.qsize(),
+        "queue_capacity": OUTBOUND_QUEUE_SIZE,
+        "inflight": inflight,
+        **counters,
+        "latency_ms": latency_summary(_latencies),
+    }
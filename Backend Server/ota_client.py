@@ -0,0 +1,221 @@
+from collections import deque
+import asyncio
+import logging
+import time
+import os
+import httpx
+from dotenv import load_dotenv
+from utils.stats import latency_summary
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+OTA_SERVER_URL = os.getenv("OTA_SERVER_URL", "http://127.0.0.1:8001")
+OTA_API_KEY = os.getenv("OTA_API_KEY")
+OTA_TIMEOUT_SECONDS = float(os.getenv("OTA_TIMEOUT_SECONDS", "5"))
+OTA_CONNECT_TIMEOUT_SECONDS = float(os.getenv("OTA_CONNECT_TIMEOUT_SECONDS", "2"))
+OTA_MAX_CONNECTIONS = int(os.getenv("OTA_MAX_CONNECTIONS", "20"))
+OTA_MAX_KEEPALIVE = int(os.getenv("OTA_MAX_KEEPALIVE", "10"))
+# How long a /version answer is reused; check-ins within it never reach the OTA server
+MANIFEST_TTL_SECONDS = float(os.getenv("OTA_MANIFEST_TTL_SECONDS", "30"))
+# Past the TTL the old manifest is still served while a refresh runs, up to this age
+MANIFEST_MAX_STALE_SECONDS = float(os.getenv("OTA_MANIFEST_MAX_STALE_SECONDS", "3600"))
+# Consecutive failures that open the circuit, and how long it stays open before a probe
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("OTA_BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("OTA_BREAKER_RESET_SECONDS", "30"))
+LATENCY_SAMPLES = 1000
+
+class CircuitOpen(Exception):
+    """Raised instead of calling the OTA server while the circuit is open."""
+
+class CircuitBreaker:
+    """Closed, open or half-open. Runs on the event loop only, so it needs no lock.
+
+    After failure_threshold consecutive failures the circuit opens and calls
+    fail fast. Once reset_seconds have passed one call is let through as a
+    probe; its outcome closes the circuit or opens it again.
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.counters = {"opened": 0, "rejected": 0, "probes": 0}
+
+    def ready(self):
+        """Whether a call would be let through, without claiming the probe."""
+        if self.state == "open":
+            return time.monotonic() - self.opened_at >= self.reset_seconds
+        return self.state == "closed"
+
+    def allow(self):
+        if self.state == "open" and self.ready():
+            self.state = "half_open"
+            self.counters["probes"] += 1
+            return True
+        if self.state == "closed":
+            return True
+        self.counters["rejected"] += 1
+        return False
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info("OTA server is reachable again, closing the circuit")
+        self.state = "closed"
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            logger.warning(f"OTA server failing ({self.failures} in a row), opening the circuit for {self.reset_seconds}s")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.counters["opened"] += 1
+
+    def release_probe(self):
+        # A probe that ended without an outcome (cancelled) must not wedge the circuit half-open
+        if self.state == "half_open":
+            self.state = "open"
+
+    def retry_after(self):
+        return max(1, int(self.reset_seconds - (time.monotonic() - self.opened_at)) + 1)
+
+    def stats(self):
+        return {"state": self.state, "consecutive_failures": self.failures, **self.counters}
+
+def _is_failure(error):
+    # Only an unavailable or overloaded server counts; a 4xx means it answered
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, httpx.TransportError)
+
+class OTAClient:
+    """Pooled connection to the OTA server, opened and closed with the app.
+
+    Every call goes through a circuit breaker. The /version manifest is cached
+    for MANIFEST_TTL_SECONDS; after that the last good manifest keeps being
+    served while one background request refreshes it, so check-ins do not wait
+    on a slow or unavailable OTA server.
+    """
+
+    def __init__(self):
+        self._client = None
+        self._manifest = None
+        self._fetched_at = 0.0
+        self._inflight = None
+        self.breaker = CircuitBreaker()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.counters = {"calls": 0, "failures": 0, "manifest_hits": 0, "manifest_stale": 0,
+                         "manifest_fetches": 0, "manifest_joined": 0}
+
+    def start(self):
+        self._client = httpx.AsyncClient(
+            base_url=OTA_SERVER_URL,
+            headers={"X-API-Key": OTA_API_KEY or ""},
+            timeout=httpx.Timeout(OTA_TIMEOUT_SECONDS, connect=OTA_CONNECT_TIMEOUT_SECONDS),
+            limits=httpx.Limits(max_connections=OTA_MAX_CONNECTIONS, max_keepalive_connections=OTA_MAX_KEEPALIVE),
+        )
+
+    async def close(self):
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
+
+    @property
+    def client(self):
+        if self._client is None:
+            raise RuntimeError("OTA client used before the app started")
+        return self._client
+
+    async def _call(self, method, path, **kwargs):
+        """One upstream request, returning the decoded JSON body.
+
+        Raises CircuitOpen without calling out while the circuit is open.
+        """
+        if not self.breaker.allow():
+            raise CircuitOpen("OTA server unavailable")
+        self.counters["calls"] += 1
+        started = time.monotonic()
+        recorded = False
+        try:
+            response = await self.client.request(method, path, **kwargs)
+            response.raise_for_status()
+            data = response.json()
+        except httpx.HTTPError as e:
+            recorded = True
+            if _is_failure(e):
+                self.counters["failures"] += 1
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        else:
+            recorded = True
+            self.breaker.record_success()
+            return data
+        finally:
+            self._latencies.append(time.monotonic() - started)
+            if not recorded:
+                self.breaker.release_probe()
+
+    async def get_manifest(self):
+        """The OTA server's /version response.
+
+        Raises httpx.HTTPError or CircuitOpen only when there is no usable
+        cached manifest.
+        """
+        if self._manifest is not None:
+            age = time.monotonic() - self._fetched_at
+            if age < MANIFEST_TTL_SECONDS:
+                self.counters["manifest_hits"] += 1
+                return self._manifest
+            if age < MANIFEST_MAX_STALE_SECONDS:
+                self.counters["manifest_stale"] += 1
+                if self._inflight is None and self.breaker.ready():
+                    self._refresh()
+                return self._manifest
+        if self._inflight is None:
+            if not self.breaker.ready():
+                # Reject here rather than schedule a fetch that would only fail in _call
+                self.breaker.counters["rejected"] += 1
+                raise CircuitOpen("OTA server unavailable")
+            self._refresh()
+        else:
+            self.counters["manifest_joined"] += 1
+        # Shielded, so one caller going away does not cancel the fetch for the rest
+        return await asyncio.shield(self._inflight)
+
+    def _refresh(self):
+        self._inflight = asyncio.ensure_future(self._fetch_manifest())
+        self._inflight.add_done_callback(self._fetch_done)
+
+    async def _fetch_manifest(self):
+        self.counters["manifest_fetches"] += 1
+        manifest = await self._call("GET", "/version")
+        self._manifest = manifest
+        self._fetched_at = time.monotonic()
+        return manifest
+
+    def _fetch_done(self, future):
+        self._inflight = None
+        if not future.cancelled() and future.exception() is not None:
+            # Also consumes the exception of a background refresh nobody awaited
+            logger.warning(f"Refreshing the OTA manifest failed: {str(future.exception()) or type(future.exception()).__name__}")
+
+    async def register_device(self, payload):
+        return await self._call("POST", "/device/register", json=payload)
+
+    def stats(self):
+        return {
+            "server": OTA_SERVER_URL,
+            "breaker": self.breaker.stats(),
+            "latency_ms": latency_summary(self._latencies),
+            "manifest_ttl_seconds": MANIFEST_TTL_SECONDS,
+            "manifest_age_seconds": round(time.monotonic() - self._fetched_at, 1) if self._manifest else None,
+            **self.counters,
+        }
+
+ota_client = OTAClient()
@@ -1,16 +1,48 @@
 from fastapi import APIRouter, HTTPException, Depends, status, Form
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from models import UserRegister, UserLogin
-from database import db
-from utils.hash import hash_password, verify_password
+from models import UserRegister, UserLogin, UserTimezone
+from database import adb
+from schedule_index import set_owner_timezone
+from utils.hash import hash_password_async, verify_and_update_async, HashPoolBusy
+from users import load_user, invalidate_user
+from functools import lru_cache
+from cache import LRUCache
 from jose import jwt, JWTError
 from datetime import timedelta, datetime
+import pytz
+import hashlib
+import os
 
 router = APIRouter()
 
 SECRET_KEY = "your_secret_key_here"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+
+def _load_signing_keys():
+    """Key id -> secret from JWT_SECRET_KEYS ("kid:secret,kid:secret").
+
+    The first key signs new tokens; the rest are still accepted, so a key can
+    be rotated by prepending a new one and dropping the old one once every
+    token it signed has expired.
+    """
+    raw = os.getenv("JWT_SECRET_KEYS")
+    if not raw:
+        return {"default": os.getenv("JWT_SECRET_KEY", SECRET_KEY)}
+    keys = {}
+    for entry in raw.split(","):
+        kid, _, secret = entry.strip().partition(":")
+        if not kid or not secret:
+            raise ValueError("JWT_SECRET_KEYS entries must look like kid:secret")
+        keys[kid] = secret
+    return keys
+
+SIGNING_KEYS = _load_signing_keys()
+ACTIVE_KID = next(iter(SIGNING_KEYS))
+
+# sha256 of the token -> email, kept until the token's exp
+token_cache = LRUCache(TOKEN_CACHE_SIZE)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -18,52 +50,116 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
     to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    return jwt.encode(to_encode, SIGNING_KEYS[ACTIVE_KID], algorithm=ALGORITHM, headers={"kid": ACTIVE_KID})
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
+def _decode_token(token):
+    kid = jwt.get_unverified_header(token).get("kid")
+    if kid is not None:
+        if kid not in SIGNING_KEYS:
+            raise JWTError("Unknown signing key")
+        return jwt.decode(token, SIGNING_KEYS[kid], algorithms=[ALGORITHM])
+    # Tokens issued before key ids were added
+    for secret in SIGNING_KEYS.values():
+        try:
+            return jwt.decode(token, secret, algorithms=[ALGORITHM])
+        except JWTError:
+            continue
+    raise JWTError("Signature verification failed")
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
+    digest = hashlib.sha256(token.encode()).hexdigest()
+    email = token_cache.get(digest)
+    if email is not None:
         return email
+    try:
+        payload = _decode_token(token)
     except JWTError:
         raise credentials_exception
+    email: str = payload.get("sub")
+    if email is None:
+        raise credentials_exception
+    if payload.get("exp") is not None:
+        token_cache.put(digest, email, expires_at=payload["exp"])
+    return email
+
+@lru_cache(maxsize=None)
+def current_user_with(*fields):
+    """Dependency resolving the signed-in user's document, limited to fields.
+
+    The same fields always give the same dependency, so FastAPI resolves it
+    once per request however many parameters ask for it.
+    """
+    async def dependency(email: str = Depends(get_current_user)):
+        user = await load_user(email, ("email",) + fields)
+        if user is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        return user
+    return dependency
+
+async def _check_password(db_user, password):
+    """Verify a login attempt, upgrading the stored hash if its cost is outdated."""
+    try:
+        valid, new_hash = await verify_and_update_async(password, db_user["password"])
+    except HashPoolBusy:
+        raise HTTPException(status_code=503, detail="Too many login attempts in progress, try again",
+                            headers={"Retry-After": "1"})
+    if valid and new_hash:
+        await adb.users.update_one({"_id": db_user["_id"], "password": db_user["password"]},
+                                   {"$set": {"password": new_hash}})
+    return valid
 
 @router.post("/register")
-def register(
+async def register(
     name: str = Form(...),
     email: str = Form(...),
     password: str = Form(...)
 ):
-    if db.users.find_one({"email": email}):
+    if await adb.users.find_one({"email": email}, {"_id": 1}):
         raise HTTPException(status_code=400, detail="Email already registered")
-    db.users.insert_one({
+    try:
+        hashed = await hash_password_async(password)
+    except HashPoolBusy:
+        raise HTTPException(status_code=503, detail="Too many registrations in progress, try again",
+                            headers={"Retry-After": "1"})
+    await adb.users.insert_one({
         "name": name,
         "email": email,
-        "password": hash_password(password),
+        "password": hashed,
         "devices": []
     })
+    invalidate_user(email)
     return {"msg": "User registered"}
 
 @router.post("/login")
-def login(user: UserLogin):
-    db_user = db.users.find_one({"email": user.email})
+async def login(user: UserLogin):
+    # Credentials are never served from the user cache
+    db_user = await adb.users.find_one({"email": user.email}, {"password": 1})
     
-    if not db_user or not verify_password(user.password, db_user["password"]):
+    if not db_user or not await _check_password(db_user, user.password):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     return {"msg": "Login successful", "user_id": str(db_user["_id"])}
 
 @router.post("/token")
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    db_user = db.users.find_one({"email": form_data.username})
-    if not db_user or not verify_password(form_data.password, db_user["password"]):
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
+    db_user = await adb.users.find_one({"email": form_data.username}, {"email": 1, "password": 1})
+    if not db_user or not await _check_password(db_user, form_data.password):
         raise HTTPException(status_code=401, detail="Incorrect email or password")
     access_token = create_access_token(data={"sub": db_user["email"]})
-    return {"access_token": access_token, "token_type": "bearer"}
\ No newline at end of file
+    return {"access_token": access_token, "token_type": "bearer"}
+
+@router.put("/user/timezone")
+async def update_timezone(data: UserTimezone, current_user: str = Depends(get_current_user)):
+    if data.timezone not in pytz.all_timezones_set:
+        raise HTTPException(status_code=400, detail="Unknown timezone")
+    result = await adb.users.update_one({"email": current_user}, {"$set": {"timezone": data.timezone}})
+    invalidate_user(current_user)
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="User not found")
+    await set_owner_timezone(current_user, data.timezone)
+    return {"msg": "Timezone updated", "timezone": data.timezone}
@@ -1,50 +1,104 @@
 from fastapi import APIRouter, HTTPException, Query, Depends
-from models import DeviceControl, DeviceRegister, DeviceSchedule
-from mqtt_client import publish
-from database import db
-from datetime import datetime
-from routes.auth import get_current_user
+from fastapi.responses import StreamingResponse
+from models import DeviceControl, BatchControl, DeviceRegister, DeviceSchedule
+from mqtt_client import publish, PublishQueueFull
+from database import adb
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from pymongo import ASCENDING
+import asyncio
+import json
+import os
+import state_store
+from routes.auth import get_current_user, current_user_with
 from bson import ObjectId
+from bson.errors import InvalidId
 from uuid import uuid4
+from pymongo.errors import DuplicateKeyError
+from schedule_index import save_schedule, delete_schedule, second_of_day
+import storage
+from storage import ensure_normalized
+from command_history import device_history
 
 router = APIRouter()
 
+# How long /device/control waits for the broker to accept a command
+PUBLISH_TIMEOUT_SECONDS = float(os.getenv("PUBLISH_TIMEOUT_SECONDS", "2"))
+BATCH_MAX_COMMANDS = int(os.getenv("BATCH_MAX_COMMANDS", "200"))
+
+async def _delivered(delivery):
+    try:
+        await asyncio.wait_for(asyncio.wrap_future(delivery), PUBLISH_TIMEOUT_SECONDS)
+        return True
+    except Exception:
+        return False
+
 @router.post("/device/control")
-def control_device(data: DeviceControl, current_user: str = Depends(get_current_user)):
+async def control_device(data: DeviceControl, current_user: str = Depends(get_current_user)):
     # Publish to MQTT
     topic = f"device/{data.device_id}/{data.relay}/set"
-    publish(topic, data.action)
-    
-    # Update database
     try:
-        # Update or insert device state
-        db.device_states.update_one(
-            {"device_id": data.device_id, "relay": data.relay},
-            {
-                "$set": {
-                    "state": data.action,
-                    "last_updated": datetime.utcnow()
-                }
-            },
-            upsert=True
-        )
-        
-        # Log the command
-        db.command_logs.insert_one({
-            "device_id": data.device_id,
-            "relay": data.relay,
-            "action": data.action,
-            "timestamp": datetime.utcnow(),
-            "source": "app"
-        })
-        
-        return {"msg": "Command sent and database updated"}
-    except Exception as e:
-        return {"msg": f"Command sent but database update failed: {str(e)}"}
+        delivery = publish(topic, data.action)
+    except PublishQueueFull:
+        raise HTTPException(status_code=503, detail="Too many pending device commands, try again")
+    delivered = await _delivered(delivery)
+
+    # State and log writes are buffered and flushed in batches
+    state_store.record_state(data.device_id, data.relay, data.action, "app")
+    state_store.log_command(data.device_id, data.relay, data.action, "app")
+    return {"msg": "Command sent", "delivered": delivered}
+
+@router.post("/device/control/batch")
+async def control_devices(data: BatchControl, current_user: str = Depends(get_current_user)):
+    commands = [(c.device_id, c.relay, c.action) for c in data.commands]
+    if data.room_name:
+        if not data.action:
+            raise HTTPException(status_code=400, detail="action is required with room_name")
+        await ensure_normalized(current_user)
+        if not await storage.room_exists(current_user, data.room_name):
+            raise HTTPException(status_code=404, detail="Room not found")
+        device_ids = await storage.room_device_ids(current_user, data.room_name)
+        if data.relays:
+            commands += [(device_id, relay, data.action) for device_id in device_ids for relay in data.relays]
+        else:
+            async for doc in adb.device_states.find({"device_id": {"$in": device_ids}}, {"device_id": 1, "relay": 1}):
+                commands.append((doc["device_id"], doc["relay"], data.action))
+    if not commands:
+        raise HTTPException(status_code=400, detail="No commands to send")
+    if len(commands) > BATCH_MAX_COMMANDS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_COMMANDS} commands per batch")
+
+    # Queue everything first so the broker round trips overlap
+    deliveries = []
+    for device_id, relay, action in commands:
+        try:
+            deliveries.append(publish(f"device/{device_id}/{relay}/set", action))
+        except PublishQueueFull:
+            deliveries.append(None)
+    delivered = await asyncio.gather(*(_delivered(d) for d in deliveries if d is not None))
+
+    results, delivered = [], iter(delivered)
+    for (device_id, relay, action), delivery in zip(commands, deliveries):
+        result = {"device_id": device_id, "relay": relay, "action": action}
+        if delivery is None:
+            result.update(queued=False, delivered=False)
+        else:
+            result.update(queued=True, delivered=next(delivered))
+            # Buffered, so the whole batch goes out in one bulk write per collection
+            state_store.record_state(device_id, relay, action, "app")
+            state_store.log_command(device_id, relay, action, "app")
+        results.append(result)
+    return {
+        "msg": "Commands sent",
+        "queued": sum(r["queued"] for r in results),
+        "delivered": sum(r["delivered"] for r in results),
+        "results": results
+    }
 
 @router.get("/device/status/{device_id}")
-def get_device_status(device_id: str):
-    device = db.device_states.find_one({"device_id": device_id})
+async def get_device_status(device_id: str, relay: Optional[str] = None):
+    # Without a relay, the most recently changed one
+    device = await state_store.get_device_state(device_id, relay)
     if not device:
         raise HTTPException(status_code=404, detail="Device not found")
     return {
@@ -55,114 +109,162 @@ def get_device_status(device_id: str):
         "is_online": True  # You may want to implement actual online check
     }
 
+STATUS_FIELDS = ("device_id", "relay", "state", "last_updated")
+STATUS_PAGE_SIZE = 100
+STATUS_MAX_PAGE_SIZE = 1000
+STATUS_STREAM_BATCH_SIZE = 500
+
+def _status_row(doc, fields):
+    row = {}
+    for field in fields:
+        if field == "last_updated":
+            row[field] = doc[field].isoformat() + "Z" if doc.get(field) else None
+        else:
+            row[field] = doc.get(field)
+    return row
+
+async def _stream_status(cursor, fields):
+    # Yield one chunk per cursor batch so memory stays flat for full exports
+    lines = []
+    async for doc in cursor:
+        lines.append(json.dumps(_status_row(doc, fields)))
+        if len(lines) == STATUS_STREAM_BATCH_SIZE:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
 @router.get("/device/status")
-def device_status():
-    devices = list(db.device_states.find())
+async def device_status(
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    limit: Optional[int] = Query(None, ge=1, le=STATUS_MAX_PAGE_SIZE),
+    device_id_prefix: Optional[str] = None,
+    relay: Optional[str] = None,
+    state: Optional[str] = None,
+    fields: Optional[str] = Query(None, description="Comma-separated subset of " + ", ".join(STATUS_FIELDS)),
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    current_user: str = Depends(get_current_user)
+):
+    selected = STATUS_FIELDS
+    if fields:
+        selected = tuple(f.strip() for f in fields.split(",") if f.strip())
+        if not selected or any(f not in STATUS_FIELDS for f in selected):
+            raise HTTPException(status_code=400, detail=f"fields must be a subset of {', '.join(STATUS_FIELDS)}")
+
+    # Only the caller's own devices, narrowed by the prefix if one is given
+    await ensure_normalized(current_user)
+    device_ids = await storage.user_device_ids(current_user)
+    if device_id_prefix:
+        device_ids = [d for d in device_ids if d.startswith(device_id_prefix)]
+    query = {"device_id": {"$in": device_ids}}
+    query["state"] = state if state else {"$exists": True}
+    if relay:
+        query["relay"] = relay
+    if cursor:
+        try:
+            query["_id"] = {"$gt": ObjectId(cursor)}
+        except InvalidId:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    projection = {field: 1 for field in selected}
+    results = adb.device_states.find(query, projection).sort("_id", ASCENDING)
+
+    if format == "ndjson":
+        if limit:
+            results = results.limit(limit)
+        return StreamingResponse(_stream_status(results.batch_size(STATUS_STREAM_BATCH_SIZE), selected),
+                                 media_type="application/x-ndjson")
+
+    page = await results.limit(limit or STATUS_PAGE_SIZE).to_list(None)
+    next_cursor = str(page[-1]["_id"]) if len(page) == (limit or STATUS_PAGE_SIZE) else None
+    return {
+        "devices": [_status_row(d, selected) for d in page],
+        "next_cursor": next_cursor
+    }
+
+HISTORY_MAX_DAYS = 366
+
+def _utc(when):
+    return when.astimezone(timezone.utc).replace(tzinfo=None) if when.tzinfo else when
+
+@router.get("/device/history/{device_id}")
+async def get_device_history(
+    device_id: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    bucket: str = Query("hour", pattern="^(hour|day)$"),
+    current_user: str = Depends(get_current_user)
+):
+    """Command counts per hour or day, served from the hourly rollups."""
+    await ensure_normalized(current_user)
+    if not await storage.device_exists(current_user, device_id):
+        raise HTTPException(status_code=404, detail="Device not found")
+    end = _utc(end) if end else datetime.utcnow()
+    start = _utc(start) if start else end - timedelta(days=1 if bucket == "hour" else 30)
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    if end - start > timedelta(days=HISTORY_MAX_DAYS):
+        raise HTTPException(status_code=400, detail=f"History is limited to {HISTORY_MAX_DAYS} days per request")
     return {
-        "devices": [
-            {
-                "device_id": d["device_id"],
-                "relay": d["relay"],
-                "state": d["state"],
-                "last_updated": d["last_updated"].isoformat() + "Z"
-            } for d in devices
-        ]
+        "device_id": device_id,
+        "bucket": bucket,
+        "history": [{**b, "start": b["start"].isoformat() + "Z"} for b in await device_history(device_id, start, end, bucket)]
     }
 
 @router.post("/device/add")
-def add_device(device: DeviceRegister, current_user: str = Depends(get_current_user)):
-    user = db.users.find_one({"email": current_user})
-    if not user or "rooms" not in user or not user["rooms"]:
-        raise HTTPException(status_code=400, detail="Please create a room first.")
-
-    # Find the room index by name
-    room_index = next((i for i, r in enumerate(user["rooms"]) if r["name"] == device.room_name), None)
-    if room_index is None:
+async def add_device(device: DeviceRegister, current_user: str = Depends(get_current_user)):
+    await ensure_normalized(current_user)
+    if not await storage.room_exists(current_user, device.room_name):
+        if not await storage.room_exists(current_user):
+            raise HTTPException(status_code=400, detail="Please create a room first.")
         raise HTTPException(status_code=404, detail="Room not found.")
 
-    # Add the device to the devices array in the selected room
-    update_result = db.users.update_one(
-        {"email": current_user, f"rooms.{room_index}.name": device.room_name},
-        {"$push": {f"rooms.{room_index}.devices": {
-            "device_id": device.device_id,
-            "device_name": device.device_name,
-            "added_at": datetime.utcnow()
-        }}}
-    )
-    if update_result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Failed to add device to room.")
+    try:
+        await storage.add_device(current_user, device.room_name, device.device_id, device.device_name)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Device is already in this room.")
 
     return {"msg": "Device added to room successfully"}
 
 @router.get("/devices/all")
-def get_all_devices(current_user: str = Depends(get_current_user)):
-    user = db.users.find_one({"email": current_user})
-    if not user or "rooms" not in user:
-        return []
-    all_devices = []
-    for room in user["rooms"]:
-        if "devices" in room:
-            for device in room["devices"]:
-                device_with_room = device.copy()
-                device_with_room["room_name"] = room["name"]
-                if "name" not in device_with_room:
-                    device_with_room["name"] = device_with_room.get("device_name", "")
-                all_devices.append(device_with_room)
-    return all_devices
+async def get_all_devices(current_user: str = Depends(get_current_user)):
+    await ensure_normalized(current_user)
+    return await storage.device_list(current_user)
 
 @router.delete("/device/delete/{device_id}")
-def delete_device(device_id: str, current_user: str = Depends(get_current_user)):
-    result = db.users.update_many(
-        {"email": current_user},
-        {"$pull": {"rooms.$[].devices": {"device_id": device_id}}}
-    )
-    if result.modified_count == 0:
+async def delete_device(device_id: str, current_user: str = Depends(get_current_user)):
+    await ensure_normalized(current_user)
+    if not await storage.delete_device(current_user, device_id):
         raise HTTPException(status_code=404, detail="Device not found in any room")
     return {"message": "Device deleted from all rooms"}
 
 @router.get("/schedules")
-def get_all_schedules(current_user: str = Depends(get_current_user)):
-    user = db.users.find_one({"email": current_user})
-    if not user or "rooms" not in user:
-        return []
-    
-    all_schedules = []
-    for room in user["rooms"]:
-        if "devices" in room:
-            for device in room["devices"]:
-                if "schedules" in device and device["schedules"]:
-                    for schedule in device["schedules"]:
-                        schedule_with_device_info = {
-                            **schedule,
-                            "device_id": device["device_id"],
-                            "device_name": device.get("device_name", ""),
-                            "room_name": room["name"]
-                        }
-                        all_schedules.append(schedule_with_device_info)
-    
-    return all_schedules
+async def get_all_schedules(current_user: str = Depends(get_current_user)):
+    await ensure_normalized(current_user)
+    return await storage.schedule_list(current_user)
 
 @router.post("/device/schedule/{device_id}")
-def add_schedule(device_id: str, schedule: DeviceSchedule, current_user: str = Depends(get_current_user)):
+async def add_schedule(device_id: str, schedule: DeviceSchedule, user: dict = Depends(current_user_with("timezone"))):
+    current_user = user["email"]
     # Assign a unique schedule_id if not present
     if not schedule.schedule_id:
         schedule.schedule_id = str(uuid4())
-    result = db.users.update_one(
-        {"email": current_user, "rooms.devices.device_id": device_id},
-        {"$push": {"rooms.$[].devices.$[dev].schedules": schedule.dict()}},
-        array_filters=[{"dev.device_id": device_id}]
-    )
-    if result.modified_count == 0:
+    try:
+        second_of_day(schedule.time)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid time, expected HH:MM or HH:MM:SS")
+    await ensure_normalized(current_user)
+    if not await storage.device_exists(current_user, device_id):
         raise HTTPException(status_code=404, detail="Device not found")
+    try:
+        await save_schedule(current_user, device_id, schedule.dict(), user.get("timezone"))
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="schedule_id is already in use")
     return {"message": "Schedule added", "schedule_id": schedule.schedule_id}
 
 @router.delete("/device/schedule/{device_id}/{schedule_id}")
-def remove_schedule(device_id: str, schedule_id: str, current_user: str = Depends(get_current_user)):
-    result = db.users.update_one(
-        {"email": current_user, "rooms.devices.device_id": device_id},
-        {"$pull": {"rooms.$[].devices.$[dev].schedules": {"schedule_id": schedule_id}}},
-        array_filters=[{"dev.device_id": device_id}]
-    )
-    if result.modified_count == 0:
+async def remove_schedule(device_id: str, schedule_id: str, current_user: str = Depends(get_current_user)):
+    await ensure_normalized(current_user)
+    if not await delete_schedule(current_user, device_id, schedule_id):
         raise HTTPException(status_code=404, detail="Schedule not found")
-    return {"message": "Schedule removed"}
\ No newline at end of file
+    return {"message": "Schedule removed"}
@@ -0,0 +1,53 @@
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, HTTPException
+import asyncio
+import storage
+import mqtt_client
+from routes.auth import get_current_user
+from state_push import Subscriber, push_registry
+
+router = APIRouter()
+
+def _token(websocket: WebSocket):
+    # Browsers cannot set headers on a WebSocket, so the token may come as ?token=
+    token = websocket.query_params.get("token")
+    if token:
+        return token
+    scheme, _, credentials = websocket.headers.get("authorization", "").partition(" ")
+    return credentials if scheme.lower() == "bearer" else None
+
+@router.websocket("/ws/devices")
+async def device_updates(websocket: WebSocket):
+    """Push state changes of the signed-in user's devices as they happen.
+
+    Sends {"type": "subscribed", "devices": [...]} once, then one
+    {"type": "state", ...} message per change. Clients that fall too far
+    behind are closed with code 1013 and should reconnect.
+    """
+    token = _token(websocket)
+    try:
+        current_user = await get_current_user(token) if token else None
+    except HTTPException:
+        current_user = None
+    if current_user is None:
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    await storage.ensure_normalized(current_user)
+    device_ids = await storage.user_device_ids(current_user)
+    mqtt_client.start_state_feed(push_registry.publish_state)
+    subscriber = Subscriber(websocket, current_user, device_ids)
+    # Registered before confirming, so no change after "subscribed" is missed
+    push_registry.add(subscriber)
+    try:
+        await websocket.send_json({"type": "subscribed", "devices": device_ids})
+        subscriber.sender = asyncio.create_task(push_registry.send_loop(subscriber))
+        # Nothing is expected from the client; reading notices the disconnect
+        while True:
+            await websocket.receive_text()
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        push_registry.remove(subscriber)
+        if subscriber.sender is not None:
+            subscriber.sender.cancel()
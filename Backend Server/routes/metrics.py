@@ -0,0 +1,50 @@
+from fastapi import APIRouter, Depends
+from pymongo.errors import PyMongoError
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import time
+import os
+import mqtt_client
+import scheduler
+import state_store
+import timers
+from state_push import push_registry
+from ota_client import ota_client
+from users import user_cache
+from routes.auth import token_cache, get_current_user
+from utils import hash as password_hash
+from database import indexes
+
+router = APIRouter()
+
+# The index report lists every index and runs $indexStats, so it is reused for a while
+INDEX_REPORT_TTL_SECONDS = float(os.getenv("METRICS_INDEX_REPORT_TTL_SECONDS", "60"))
+_index_report = None
+_index_report_at = 0.0
+_index_report_lock = asyncio.Lock()
+
+async def _cached_index_report():
+    global _index_report, _index_report_at
+    async with _index_report_lock:
+        if _index_report is None or time.monotonic() - _index_report_at >= INDEX_REPORT_TTL_SECONDS:
+            try:
+                _index_report = await run_in_threadpool(indexes.report)
+            except PyMongoError as e:
+                _index_report = {"error": str(e)}
+            _index_report_at = time.monotonic()
+        return _index_report
+
+@router.get("/metrics")
+async def get_metrics(current_user: str = Depends(get_current_user)):
+    return {
+        "scheduler": scheduler.get_stats(),
+        "timers": timers.get_stats(),
+        "mqtt": mqtt_client.get_stats(),
+        "state_store": state_store.get_stats(),
+        "indexes": await _cached_index_report(),
+        "user_cache": user_cache.stats(),
+        "token_cache": token_cache.stats(),
+        "password_hashing": password_hash.get_stats(),
+        "state_push": push_registry.stats(),
+        "ota_client": ota_client.stats(),
+    }
@@ -1,8 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException, Path
 from pydantic import BaseModel
 from typing import Optional
-from database import db
+from pymongo.errors import DuplicateKeyError
+import storage
 from routes.auth import get_current_user
+from storage import ensure_normalized
 
 router = APIRouter()
 
@@ -11,28 +13,22 @@ class Room(BaseModel):
     description: Optional[str] = None
 
 @router.post("/room/add")
-def add_room(room: Room, current_user: str = Depends(get_current_user)):
-    result = db.users.update_one(
-        {"email": current_user},
-        {"$push": {"rooms": room.dict()}}
-    )
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="User not found")
+async def add_room(room: Room, current_user: str = Depends(get_current_user)):
+    await ensure_normalized(current_user)
+    try:
+        await storage.add_room(current_user, room.name, room.description)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Room already exists")
     return {"message": "Room added to user"}
 
 @router.get("/rooms")
-def get_rooms(current_user: str = Depends(get_current_user)):
-    user = db.users.find_one({"email": current_user})
-    if not user or "rooms" not in user:
-        return []
-    return user["rooms"]
+async def get_rooms(current_user: str = Depends(get_current_user)):
+    await ensure_normalized(current_user)
+    return await storage.room_tree(current_user)
 
 @router.delete("/room/delete/{room_name}")
-def delete_room(room_name: str = Path(...), current_user: str = Depends(get_current_user)):
-    result = db.users.update_one(
-        {"email": current_user},
-        {"$pull": {"rooms": {"name": room_name}}}
-    )
-    if result.modified_count == 0:
+async def delete_room(room_name: str = Path(...), current_user: str = Depends(get_current_user)):
+    await ensure_normalized(current_user)
+    if not await storage.delete_room(current_user, room_name):
         raise HTTPException(status_code=404, detail="Room not found or already deleted")
     return {"message": "Room and its devices deleted"} 
\ No newline at end of file
@@ -0,0 +1,31 @@
+from fastapi import APIRouter, HTTPException, Depends
+from models import TimerCreate, TimerResponse, TimerInfo, TimersListResponse, TimerDeleteResponse
+from starlette.concurrency import run_in_threadpool
+from storage import device_exists, ensure_normalized
+from routes.auth import get_current_user
+from timers import create_timer, list_timers, delete_timer
+from uuid import uuid4
+
+router = APIRouter()
+
+@router.post("/device/timer", response_model=TimerResponse)
+async def add_timer(data: TimerCreate, current_user: str = Depends(get_current_user)):
+    await ensure_normalized(current_user)
+    if not await device_exists(current_user, data.device_id):
+        raise HTTPException(status_code=404, detail="Device not found")
+    # The timer engine is shared with its worker threads, so it stays sync
+    timer = await run_in_threadpool(create_timer, current_user, str(uuid4()), data.device_id, data.relay, data.action, data.execute_at)
+    return TimerResponse(msg="Timer created", timer_id=timer["_id"])
+
+@router.get("/device/timers/{device_id}", response_model=TimersListResponse)
+async def get_timers(device_id: str, current_user: str = Depends(get_current_user)):
+    return TimersListResponse(timers=[
+        TimerInfo(timer_id=t["_id"], relay=t["relay"], action=t["action"], execute_at=t["execute_at"])
+        async for t in list_timers(current_user, device_id)
+    ])
+
+@router.delete("/device/timer/{timer_id}", response_model=TimerDeleteResponse)
+async def remove_timer(timer_id: str, current_user: str = Depends(get_current_user)):
+    if not await delete_timer(current_user, timer_id):
+        raise HTTPException(status_code=404, detail="Timer not found")
+    return TimerDeleteResponse(msg="Timer deleted")
@@ -0,0 +1,90 @@
+from datetime import datetime
+from pymongo import ASCENDING
+from database import db, adb, indexes
+from leases import shard_of
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# One document per schedule, keyed by schedule_id. This is where schedules
+# are stored; scheduler ticks are served from the in-memory cache built
+# from it, not by querying it.
+schedules = db.schedules
+
+# Schedules created before relays were recorded keep the old topic
+LEGACY_RELAY = "relay"
+
+# Used for users who have not set a timezone
+DEFAULT_TIMEZONE = os.getenv("SCHEDULER_DEFAULT_TIMEZONE", "Asia/Kolkata")
+
+indexes.declare("schedules", ["owner", "device_id", "created_at"])
+# Scheduler nodes load only the shards they hold
+indexes.declare("schedules", ["shard"])
+
+def second_of_day(time_str):
+    """Convert an "HH:MM" or "HH:MM:SS" string into seconds since midnight."""
+    parts = [int(p) for p in time_str.split(":")]
+    if len(parts) == 2:
+        parts.append(0)
+    if len(parts) != 3:
+        raise ValueError(f"Invalid time: {time_str}")
+    hours, minutes, seconds = parts
+    if not (0 <= hours < 24 and 0 <= minutes < 60 and 0 <= seconds < 60):
+        raise ValueError(f"Invalid time: {time_str}")
+    return hours * 3600 + minutes * 60 + seconds
+
+def schedule_doc(owner, device_id, schedule, timezone):
+    seconds = second_of_day(schedule["time"])
+    return {
+        "_id": schedule["schedule_id"],
+        "owner": owner,
+        "shard": shard_of(owner),
+        "device_id": device_id,
+        "relay": schedule.get("relay"),
+        "action": schedule["action"],
+        "time": schedule["time"],
+        "days_of_week": schedule["days_of_week"],
+        "minute_of_day": seconds // 60,
+        "second_of_day": seconds,
+        "timezone": timezone,
+        "created_at": schedule.get("created_at") or datetime.utcnow(),
+    }
+
+async def save_schedule(owner, device_id, schedule, timezone=None):
+    """Create or replace one of the owner's schedules.
+
+    Raises DuplicateKeyError if the schedule_id belongs to another owner.
+    """
+    doc = schedule_doc(owner, device_id, schedule, timezone or DEFAULT_TIMEZONE)
+    await adb.schedules.replace_one({"_id": doc["_id"], "owner": owner}, doc, upsert=True)
+
+async def delete_schedule(owner, device_id, schedule_id):
+    result = await adb.schedules.delete_one({"_id": schedule_id, "owner": owner, "device_id": device_id})
+    return result.deleted_count > 0
+
+async def delete_device_schedules(owner, device_ids):
+    if device_ids:
+        await adb.schedules.delete_many({"owner": owner, "device_id": {"$in": list(device_ids)}})
+
+# What schedule_view and the per-device grouping read
+VIEW_FIELDS = {"device_id": 1, "action": 1, "time": 1, "days_of_week": 1, "relay": 1}
+
+def list_schedules(owner, device_ids=None):
+    query = {"owner": owner}
+    if device_ids is not None:
+        query["device_id"] = {"$in": list(device_ids)}
+    return adb.schedules.find(query, VIEW_FIELDS).sort([("created_at", ASCENDING), ("_id", ASCENDING)])
+
+def schedule_view(doc):
+    """A schedule document in the shape the API has always returned."""
+    return {
+        "action": doc["action"],
+        "time": doc["time"],
+        "days_of_week": doc["days_of_week"],
+        "relay": doc.get("relay"),
+        "schedule_id": doc["_id"],
+    }
+
+async def set_owner_timezone(owner, timezone):
+    await adb.schedules.update_many({"owner": owner}, {"$set": {"timezone": timezone}})
@@ -1,26 +1,356 @@
-from apscheduler.schedulers.background import BackgroundScheduler
-from datetime import datetime
+from datetime import datetime, timedelta, time as dt_time
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import chain
+from functools import lru_cache, partial
+from pymongo.errors import OperationFailure, PyMongoError
+import itertools
+import threading
+import heapq
+import logging
+import time
+import os
 import pytz  # For timezone handling
-from database import db
 from mqtt_client import publish  # Assumes you have a publish function
+from database import db
+from leases import lease_manager, shard_of, backfill_shards
+from schedule_index import schedules, DEFAULT_TIMEZONE, LEGACY_RELAY
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL_SECONDS = int(os.getenv("SCHEDULER_POLL_SECONDS", "15"))
+RETRY_DELAY_SECONDS = 5
+JITTER_SECONDS = float(os.getenv("SCHEDULER_JITTER_MS", "500")) / 1000
+CATCHUP_SECONDS = int(os.getenv("SCHEDULER_CATCHUP_SECONDS", "300"))
+CHECKPOINT_SECONDS = 10
+FANOUT_WORKERS = int(os.getenv("SCHEDULER_FANOUT_WORKERS", "8"))
+FANOUT_BATCH_SIZE = int(os.getenv("SCHEDULER_FANOUT_BATCH_SIZE", "100"))
+
+DAY_NAMES = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+# Change stream error codes
+NOT_A_REPLICA_SET = 40573
+CHANGE_STREAM_HISTORY_LOST = 286
+CHANGE_STREAM_FATAL = 280
+
+@lru_cache(maxsize=None)
+def _timezone(name):
+    try:
+        return pytz.timezone(name or DEFAULT_TIMEZONE)
+    except pytz.UnknownTimeZoneError:
+        logger.warning(f"Unknown timezone {name}, using {DEFAULT_TIMEZONE}")
+        return pytz.timezone(DEFAULT_TIMEZONE)
+
+def next_fire_time(schedule, after):
+    """Return the first UTC timestamp strictly after `after` at which the schedule fires."""
+    tz = _timezone(schedule.get("timezone"))
+    seconds = schedule.get("second_of_day", schedule["minute_of_day"] * 60)
+    local_day = datetime.fromtimestamp(after, tz).date()
+    days = schedule["days_of_week"]
+    for offset in range(8):
+        day = local_day + timedelta(days=offset)
+        if DAY_NAMES[day.weekday()] not in days:
+            continue
+        fire_at = tz.localize(datetime.combine(day, dt_time()) + timedelta(seconds=seconds)).timestamp()
+        if fire_at > after:
+            return fire_at
+    return None
+
+class ScheduleCache:
+    """In-memory copy of the schedule index, ordered by next fire time in a heap."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._by_id = {}
+        self._heap = []  # (fire_at, seq, doc); stale entries are dropped when popped
+        self._seq = itertools.count()
+        self.loaded = threading.Event()
+        self.mode = "starting"
+        self.reloads = 0
+        self.events_applied = 0
+        self.last_sync = None
+        self.last_event_lag = None
+
+    def _push(self, doc, after):
+        fire_at = next_fire_time(doc, after)
+        if fire_at is not None:
+            heapq.heappush(self._heap, (fire_at, next(self._seq), doc))
+
+    def load(self, docs, after):
+        """Replace the cache; after(doc) gives the time from which each schedule is due."""
+        with self._cond:
+            self._by_id = {}
+            self._heap = []
+            self._add(docs, after)
+            self.reloads += 1
+            self.last_sync = time.time()
+            self.loaded.set()
+
+    def add(self, docs, after):
+        with self._cond:
+            self._add(docs, after)
+
+    def _add(self, docs, after):
+        for doc in docs:
+            self._by_id[doc["_id"]] = doc
+            self._push(doc, after(doc))
+        self._compact()
+        self._cond.notify()
+
+    def drop(self, predicate):
+        with self._cond:
+            for schedule_id in [k for k, doc in self._by_id.items() if predicate(doc)]:
+                del self._by_id[schedule_id]
+            self._compact()
+
+    def upsert(self, doc, cluster_time=None):
+        with self._cond:
+            self._by_id[doc["_id"]] = doc
+            self._push(doc, time.time())
+            self._mark_event(cluster_time)
+            self._compact()
+            self._cond.notify()
+
+    def remove(self, schedule_id, cluster_time=None):
+        with self._cond:
+            self._by_id.pop(schedule_id, None)
+            self._mark_event(cluster_time)
+            self._compact()
+
+    def _mark_event(self, cluster_time):
+        self.events_applied += 1
+        self.last_sync = time.time()
+        if cluster_time is not None:
+            self.last_event_lag = max(0.0, self.last_sync - cluster_time.time)
+
+    def _compact(self):
+        # Superseded heap entries are skipped lazily; rebuild once they dominate
+        if len(self._heap) > 2 * len(self._by_id) + 1000:
+            self._heap = [e for e in self._heap if self._by_id.get(e[2]["_id"]) is e[2]]
+            heapq.heapify(self._heap)
+
+    def wait_for_next(self, max_wait):
+        with self._cond:
+            timeout = max_wait
+            if self._heap:
+                timeout = min(max_wait, self._heap[0][0] - time.time())
+            if timeout > 0:
+                self._cond.wait(timeout)
+
+    def pop_due(self, now):
+        """Pop entries due by now (plus the jitter budget), dropping those past the catch-up window."""
+        due, skipped = [], 0
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now + JITTER_SECONDS:
+                fire_at, _, doc = heapq.heappop(self._heap)
+                if self._by_id.get(doc["_id"]) is not doc:
+                    continue
+                if now - fire_at > CATCHUP_SECONDS:
+                    skipped += 1
+                else:
+                    due.append((fire_at, doc))
+                self._push(doc, fire_at)
+        return due, skipped
+
+    def stats(self):
+        with self._cond:
+            return {
+                "mode": self.mode,
+                "size": len(self._by_id),
+                "heap_entries": len(self._heap),
+                "next_fire_in_seconds": round(self._heap[0][0] - time.time(), 3) if self._heap else None,
+                "reloads": self.reloads,
+                "events_applied": self.events_applied,
+                "seconds_since_sync": None if self.last_sync is None else round(time.time() - self.last_sync, 3),
+                "last_event_lag_seconds": self.last_event_lag,
+            }
+
+schedule_cache = ScheduleCache()
+
+# Per held shard, the time up to which its schedules have been handled.
+# Guarded by _shard_lock so shard hand-over and ticks do not interleave.
+_handled_until = {}
+_shard_lock = threading.Lock()
+
+def _after(doc):
+    return _handled_until.get(shard_of(doc["owner"])) or time.time()
+
+def _owned(shards):
+    return schedules.find({"shard": {"$in": list(shards)}})
+
+def _reload_cache():
+    with _shard_lock:
+        schedule_cache.load(_owned(set(_handled_until)), _after)
+    logger.info(f"Loaded {schedule_cache.stats()['size']} schedules into cache")
+
+def _on_shards_changed(acquired, lost):
+    with _shard_lock:
+        for shard in lost:
+            _handled_until.pop(shard, None)
+        if lost:
+            schedule_cache.drop(lambda doc: shard_of(doc["owner"]) in lost)
+        if acquired:
+            # Resume each new shard from its previous holder's checkpoint
+            for shard in acquired:
+                _handled_until[shard] = _load_checkpoint(shard)
+            schedule_cache.add(_owned(acquired), _after)
+
+def _apply_change(change):
+    op = change["operationType"]
+    cluster_time = change.get("clusterTime")
+    if op in ("insert", "update", "replace"):
+        doc = change.get("fullDocument")
+        if doc is None or shard_of(doc["owner"]) not in _handled_until:
+            schedule_cache.remove(change["documentKey"]["_id"], cluster_time)
+        else:
+            schedule_cache.upsert(doc, cluster_time)
+    elif op == "delete":
+        schedule_cache.remove(change["documentKey"]["_id"], cluster_time)
+    elif op in ("drop", "rename", "invalidate"):
+        _reload_cache()
+
+def _poll_forever():
+    schedule_cache.mode = "polling"
+    logger.warning(f"Change streams unavailable, polling schedules every {POLL_INTERVAL_SECONDS}s")
+    while True:
+        try:
+            _reload_cache()
+        except PyMongoError as e:
+            logger.error(f"Error polling schedules: {str(e)}")
+        time.sleep(POLL_INTERVAL_SECONDS)
+
+def _sync_cache():
+    resume_token = None
+    while True:
+        try:
+            # Open the stream before loading so nothing between the two is missed
+            with schedules.watch(full_document="updateLookup", resume_after=resume_token) as stream:
+                if resume_token is None:
+                    _reload_cache()
+                schedule_cache.mode = "change_stream"
+                for change in stream:
+                    _apply_change(change)
+                    resume_token = stream.resume_token
+        except OperationFailure as e:
+            if e.code == NOT_A_REPLICA_SET:
+                return _poll_forever()
+            if e.code in (CHANGE_STREAM_HISTORY_LOST, CHANGE_STREAM_FATAL):
+                logger.warning("Schedule change stream lost its resume point, rebuilding cache")
+                resume_token = None
+                continue
+            logger.error(f"Schedule change stream failed: {str(e)}")
+        except PyMongoError as e:
+            logger.error(f"Schedule change stream error: {str(e)}")
+        schedule_cache.mode = "reconnecting"
+        time.sleep(RETRY_DELAY_SECONDS)
+
+fanout_pool = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="schedule-fanout")
+last_tick = {}
+_tick_lock = threading.Lock()
+tick_counters = {"fired": 0, "late": 0, "skipped": 0}
+
+def _publish_batch(batch):
+    deliveries = []
+    for schedule in batch:
+        try:
+            deliveries.append(publish(f"device/{schedule['device_id']}/{schedule.get('relay') or LEGACY_RELAY}/set", schedule["action"]))
+        except Exception as e:
+            logger.error(f"Error executing schedule {schedule['_id']}: {str(e)}")
+    return deliveries
+
+def _on_delivered(tick, due_at, delivery):
+    # Runs on the MQTT thread as the broker acknowledges each message
+    with _tick_lock:
+        tick["pending"] -= 1
+        if delivery.cancelled() or delivery.exception() is not None:
+            tick["failed"] += 1
+        else:
+            tick["delivered"] += 1
+        if tick["pending"] == 0:
+            tick["due_to_last_delivery_seconds"] = round(time.time() - due_at, 3)
+
+def dispatch(due, due_at):
+    """Queue due schedules for publishing in batches across the fan-out pool.
+
+    Only queueing happens on the engine thread; delivery results are filled
+    into the tick record by callbacks, so a slow broker cannot delay the
+    next tick.
+    """
+    global last_tick
+    started = time.time()
+    batches = [due[i:i + FANOUT_BATCH_SIZE] for i in range(0, len(due), FANOUT_BATCH_SIZE)]
+    done, _ = wait([fanout_pool.submit(_publish_batch, batch) for batch in batches])
+    deliveries = list(chain.from_iterable(f.result() for f in done))
+    finished = time.time()
+    tick = {
+        "due_at": due_at.isoformat(),
+        "queued": len(deliveries),
+        "delivered": 0,
+        "failed": len(due) - len(deliveries),
+        "pending": len(deliveries),
+        "batches": len(batches),
+        "dispatch_seconds": round(finished - started, 3),
+        "due_to_last_publish_seconds": round(finished - due_at.timestamp(), 3),
+    }
+    last_tick = tick
+    for delivery in deliveries:
+        delivery.add_done_callback(partial(_on_delivered, tick, due_at.timestamp()))
+    return tick
+
+def check_and_execute_schedules(now=None):
+    """Fire every schedule that is due now, catching up on slots missed within the window."""
+    with _shard_lock:
+        now = now or time.time()
+        due, skipped = schedule_cache.pop_due(now)
+        for shard in _handled_until:
+            _handled_until[shard] = now
+    # A lease may have lapsed since the entry was cached
+    due = [(fire_at, doc) for fire_at, doc in due if lease_manager.owns(doc["owner"])]
+    if skipped:
+        tick_counters["skipped"] += skipped
+        logger.warning(f"Skipped {skipped} schedules missed by more than {CATCHUP_SECONDS}s")
+    if not due:
+        return
+    late = sum(1 for fire_at, _ in due if now - fire_at > JITTER_SECONDS)
+    tick_counters["fired"] += len(due)
+    tick_counters["late"] += late
+    tick = dispatch([doc for _, doc in due], datetime.fromtimestamp(min(f for f, _ in due), pytz.utc))
+    logger.info(f"Queued {tick['queued']} schedules due at {tick['due_at']} "
+                f"({tick['due_to_last_publish_seconds']}s after due time, {late} late)")
+
+def _load_checkpoint(shard):
+    state = db.scheduler_state.find_one({"_id": f"checkpoint:{shard}"}) or {}
+    # Replay at most the catch-up window after a restart or failover
+    return max(state.get("cursor", 0), time.time() - CATCHUP_SECONDS)
+
+def _save_checkpoint():
+    for shard, cursor in list(_handled_until.items()):
+        db.scheduler_state.update_one({"_id": f"checkpoint:{shard}"}, {"$set": {"cursor": cursor}}, upsert=True)
+
+def _run_engine():
+    schedule_cache.loaded.wait()
+    last_checkpoint = 0
+    while True:
+        schedule_cache.wait_for_next(CHECKPOINT_SECONDS)
+        try:
+            check_and_execute_schedules()
+        except Exception as e:
+            logger.error(f"Error executing schedules: {str(e)}")
+        if time.time() - last_checkpoint >= CHECKPOINT_SECONDS:
+            try:
+                _save_checkpoint()
+                last_checkpoint = time.time()
+            except PyMongoError as e:
+                logger.error(f"Error saving scheduler checkpoint: {str(e)}")
 
-def check_and_execute_schedules():
-    now = datetime.now(pytz.timezone("Asia/Kolkata"))  # Set your timezone
-    current_time = now.strftime("%H:%M")
-    current_day = now.strftime("%A")  # e.g., "Monday"
-
-    users = db.users.find({})
-    for user in users:
-        for room in user.get("rooms", []):
-            for device in room.get("devices", []):
-                for schedule in device.get("schedules", []):
-                    if current_time == schedule["time"] and current_day in schedule["days_of_week"]:
-                        # Execute the action (e.g., send MQTT command)
-                        topic = f"device/{device['device_id']}/relay/set"
-                        publish(topic, schedule["action"])
-                        print(f"Executed {schedule['action']} for {device['device_id']} at {current_time} on {current_day}")
+def get_stats():
+    with _tick_lock:
+        tick = dict(last_tick)
+    return {"leases": lease_manager.stats(), "cache": schedule_cache.stats(), "counters": dict(tick_counters), "last_tick": tick}
 
 def start_scheduler():
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(check_and_execute_schedules, 'interval', minutes=1)
-    scheduler.start() 
\ No newline at end of file
+    # Before the first lease is taken, which loads shards by their stored value
+    backfill_shards(schedules)
+    lease_manager.add_listener(_on_shards_changed)
+    lease_manager.start()
+    threading.Thread(target=_sync_cache, daemon=True).start()
+    threading.Thread(target=_run_engine, daemon=True).start()
@@ -0,0 +1,134 @@
+from collections import defaultdict
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Messages buffered per connection before it counts as a slow consumer
+SEND_BUFFER_SIZE = int(os.getenv("PUSH_SEND_BUFFER_SIZE", "100"))
+SLOW_CONSUMER_CLOSE_CODE = 1013  # Try again later
+
+class Subscriber:
+    def __init__(self, websocket, owner, device_ids):
+        self.websocket = websocket
+        self.owner = owner
+        self.device_ids = set(device_ids)
+        self.queue = asyncio.Queue(maxsize=SEND_BUFFER_SIZE)
+        self.sender = None
+
+class PushRegistry:
+    """Fans device state changes out to the WebSocket subscribers that own the device.
+
+    Fed by mqtt_client.start_state_feed, which sees every state report and
+    relay command whichever worker handled it. All bookkeeping happens on the
+    event loop; publish_state runs on the MQTT thread and hands over with
+    call_soon_threadsafe. Idle subscribers cost a queue and two parked tasks,
+    nothing is polled.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._by_user = defaultdict(set)
+        self._by_device = defaultdict(set)
+        self.counters = {"published": 0, "sent": 0, "evicted": 0}
+
+    def add(self, subscriber):
+        self._loop = asyncio.get_running_loop()
+        self._by_user[subscriber.owner].add(subscriber)
+        for device_id in subscriber.device_ids:
+            self._by_device[device_id].add(subscriber)
+
+    def remove(self, subscriber):
+        subscribers = self._by_user.get(subscriber.owner)
+        if subscribers is None or subscriber not in subscribers:
+            return
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del self._by_user[subscriber.owner]
+        self._unsubscribe(subscriber, subscriber.device_ids)
+
+    def _unsubscribe(self, subscriber, device_ids):
+        for device_id in device_ids:
+            subscribers = self._by_device.get(device_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._by_device[device_id]
+
+    def is_connected(self, owner):
+        return owner in self._by_user
+
+    def resubscribe(self, owner, device_ids):
+        """Point an owner's open connections at a new set of devices."""
+        device_ids = set(device_ids)
+        for subscriber in self._by_user.get(owner, ()):
+            self._unsubscribe(subscriber, subscriber.device_ids - device_ids)
+            for device_id in device_ids - subscriber.device_ids:
+                self._by_device[device_id].add(subscriber)
+            subscriber.device_ids = set(device_ids)
+
+    def publish_state(self, device_id, relay, state, last_updated, source):
+        # Cheap check first: most devices have nobody watching
+        if self._loop is None or device_id not in self._by_device:
+            return
+        message = {
+            "type": "state",
+            "device_id": device_id,
+            "relay": relay,
+            "state": state,
+            "last_updated": last_updated.isoformat() + "Z",
+            "source": source,
+        }
+        try:
+            self._loop.call_soon_threadsafe(self._fanout, device_id, message)
+        except RuntimeError:
+            # The loop has shut down
+            pass
+
+    def _fanout(self, device_id, message):
+        self.counters["published"] += 1
+        for subscriber in list(self._by_device.get(device_id, ())):
+            try:
+                subscriber.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self._evict(subscriber)
+
+    def _evict(self, subscriber):
+        # A consumer this far behind would only receive stale states; it can
+        # reconnect and re-read current status instead
+        logger.warning(f"Evicting slow WebSocket consumer for {subscriber.owner}")
+        self.counters["evicted"] += 1
+        self.remove(subscriber)
+        if subscriber.sender is not None:
+            subscriber.sender.cancel()
+        asyncio.ensure_future(self._close(subscriber))
+
+    async def _close(self, subscriber):
+        try:
+            await subscriber.websocket.close(code=SLOW_CONSUMER_CLOSE_CODE)
+        except Exception:
+            pass
+
+    async def send_loop(self, subscriber):
+        try:
+            while True:
+                message = await subscriber.queue.get()
+                await subscriber.websocket.send_json(message)
+                self.counters["sent"] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # The socket went away; the receive side cleans up
+            pass
+
+    def stats(self):
+        return {
+            "users": len(self._by_user),
+            "connections": sum(len(s) for s in self._by_user.values()),
+            "watched_devices": len(self._by_device),
+            "send_buffer_size": SEND_BUFFER_SIZE,
+            **self.counters,
+        }
+
+push_registry = PushRegistry()
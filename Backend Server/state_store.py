@@ -0,0 +1,258 @@
+from datetime import datetime
+from collections import deque
+from abc import ABC, abstractmethod
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+import threading
+import logging
+import atexit
+import os
+from database import db, adb
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SIZE = int(os.getenv("STATE_FLUSH_SIZE", "500"))
+FLUSH_INTERVAL_SECONDS = float(os.getenv("STATE_FLUSH_INTERVAL_SECONDS", "1"))
+LOG_FLUSH_SIZE = int(os.getenv("COMMAND_LOG_FLUSH_SIZE", "500"))
+LOG_FLUSH_INTERVAL_SECONDS = float(os.getenv("COMMAND_LOG_FLUSH_INTERVAL_SECONDS", "1"))
+LOG_MAX_PENDING = int(os.getenv("COMMAND_LOG_MAX_PENDING", "50000"))
+STATE_CACHE_SIZE = int(os.getenv("DEVICE_STATE_CACHE_SIZE", "10000"))
+# Bounds staleness should the state feed miss an update, e.g. while reconnecting
+STATE_CACHE_TTL_SECONDS = float(os.getenv("DEVICE_STATE_CACHE_TTL_SECONDS", "10"))
+
+class BackgroundBuffer(ABC):
+    """Base for buffers flushed by a background thread on a size or time trigger."""
+
+    def __init__(self, collection, flush_size, flush_interval):
+        self.collection = collection
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._started = False
+
+    @abstractmethod
+    def flush(self):
+        """Write out everything buffered and return the number of writes."""
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            threading.Thread(target=self._run, daemon=True).start()
+            atexit.register(self.flush)
+
+class WriteBehindBuffer(BackgroundBuffer):
+    """Coalesces upserts per key in memory and writes them with one bulk_write.
+
+    Repeated updates to the same key between flushes are merged, so a device
+    reporting every second costs at most one write per flush interval.
+    """
+
+    def __init__(self, collection, key_fields, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL_SECONDS):
+        super().__init__(collection, flush_size, flush_interval)
+        self.key_fields = key_fields
+        self._pending = {}  # key tuple -> fields to $set
+        self.counters = {"recorded": 0, "written": 0, "flushes": 0, "errors": 0}
+
+    def record(self, key, fields):
+        with self._lock:
+            self._pending.setdefault(key, {}).update(fields)
+            self.counters["recorded"] += 1
+            if len(self._pending) >= self.flush_size:
+                self._wake.set()
+
+    def pending(self, key):
+        with self._lock:
+            fields = self._pending.get(key)
+            return dict(fields) if fields is not None else None
+
+    def pending_where(self, predicate):
+        with self._lock:
+            return {key: dict(fields) for key, fields in self._pending.items() if predicate(key)}
+
+    def flush(self):
+        # One flush at a time keeps writes for a key in order
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+            ops = [UpdateOne(dict(zip(self.key_fields, key)), {"$set": fields}, upsert=True)
+                   for key, fields in batch.items()]
+            try:
+                self.collection.bulk_write(ops, ordered=False)
+            except BulkWriteError as e:
+                # Rejected writes would fail again, so they are not retried
+                logger.error(f"{len(e.details['writeErrors'])} writes to {self.collection.name} were rejected")
+                self.counters["errors"] += 1
+                return 0
+            except PyMongoError as e:
+                logger.error(f"Error flushing {len(ops)} writes to {self.collection.name}: {str(e)}")
+                self.counters["errors"] += 1
+                with self._lock:
+                    # Put the batch back underneath anything recorded since
+                    for key, fields in batch.items():
+                        self._pending[key] = {**fields, **self._pending.get(key, {})}
+                return 0
+            self.counters["written"] += len(ops)
+            self.counters["flushes"] += 1
+            return len(ops)
+
+    def stats(self):
+        with self._lock:
+            return {"pending": len(self._pending), **self.counters}
+
+class AppendBuffer(BackgroundBuffer):
+    """Batches inserts with insert_many.
+
+    Holds at most max_pending documents; if Mongo falls behind that far the
+    oldest buffered documents are dropped and counted rather than growing memory.
+    """
+
+    def __init__(self, collection, max_pending, flush_size, flush_interval):
+        super().__init__(collection, flush_size, flush_interval)
+        self._pending = deque(maxlen=max_pending)
+        self.counters = {"appended": 0, "written": 0, "flushes": 0, "errors": 0, "dropped": 0}
+
+    def append(self, doc):
+        with self._lock:
+            if len(self._pending) == self._pending.maxlen:
+                self.counters["dropped"] += 1
+            self._pending.append(doc)
+            self.counters["appended"] += 1
+            if len(self._pending) >= self.flush_size:
+                self._wake.set()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._pending)
+                self._pending.clear()
+            if not batch:
+                return 0
+            try:
+                self.collection.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                # Documents that were rejected (or already inserted) are not retried
+                self.counters["errors"] += 1
+                self.counters["written"] += e.details["nInserted"]
+                self.counters["dropped"] += len(e.details["writeErrors"])
+                logger.error(f"{len(e.details['writeErrors'])} inserts to {self.collection.name} were rejected")
+                return e.details["nInserted"]
+            except PyMongoError as e:
+                logger.error(f"Error flushing {len(batch)} inserts to {self.collection.name}: {str(e)}")
+                self.counters["errors"] += 1
+                with self._lock:
+                    # Retry ahead of newer documents; whatever no longer fits is dropped
+                    room = self._pending.maxlen - len(self._pending)
+                    self.counters["dropped"] += max(0, len(batch) - room)
+                    self._pending.extendleft(reversed(batch[-room:] if room else []))
+                return 0
+            self.counters["written"] += len(batch)
+            self.counters["flushes"] += 1
+            return len(batch)
+
+    def stats(self):
+        with self._lock:
+            return {"pending": len(self._pending), **self.counters}
+
+state_writer = WriteBehindBuffer(db.device_states, ("device_id", "relay"))
+telemetry_writer = WriteBehindBuffer(db.device_telemetry, ("device_id",))
+command_log = AppendBuffer(db.command_logs, LOG_MAX_PENDING, LOG_FLUSH_SIZE, LOG_FLUSH_INTERVAL_SECONDS)
+# device_id -> {relay: latest state}, as served by /device/status/{device_id}.
+# Kept current on every worker by the MQTT state feed (apply_feed).
+state_cache = LRUCache(STATE_CACHE_SIZE, ttl=STATE_CACHE_TTL_SECONDS)
+# Serializes read-modify-write of a device's relay map
+_cache_lock = threading.Lock()
+
+# Sources that prove the device itself is online
+DEVICE_SOURCES = {"device"}
+
+def record_state(device_id, relay, state, source):
+    now = datetime.utcnow()
+    fields = {"source": source}
+    if source in DEVICE_SOURCES:
+        fields["last_seen"] = now
+    if state is not None:
+        fields.update({"state": state, "last_updated": now})
+        # Update rather than drop the cached entry: Mongo lags behind the buffer
+        _cache_state(device_id, relay, state, now)
+    state_writer.record((device_id, relay), fields)
+
+def _cache_state(device_id, relay, state, when):
+    with _cache_lock:
+        relays = state_cache.peek(device_id)
+        # Devices not cached are loaded whole on their next lookup
+        if relays is not None:
+            # Copied, so a reader never sees the map change under it
+            state_cache.put(device_id, {**relays, relay: {"device_id": device_id, "relay": relay, "state": state, "last_updated": when}})
+
+def apply_feed(device_id, relay, state, when, source):
+    """State feed listener: changes ingested or commanded by any worker."""
+    _cache_state(device_id, relay, state, when)
+
+async def _load_relays(device_id):
+    relays = {}
+    async for doc in adb.device_states.find({"device_id": device_id, "state": {"$exists": True}}):
+        relays[doc["relay"]] = {"device_id": device_id, "relay": doc["relay"], "state": doc["state"], "last_updated": doc["last_updated"]}
+    # Overlay changes that are still waiting to be flushed
+    for (_, relay), fields in state_writer.pending_where(lambda key: key[0] == device_id).items():
+        if "state" in fields:
+            relays[relay] = {"device_id": device_id, "relay": relay, "state": fields["state"], "last_updated": fields["last_updated"]}
+    return relays
+
+async def get_device_state(device_id, relay=None):
+    """Read-through lookup of a relay's latest state, or None if unknown.
+
+    Without a relay, the state of the device's most recently changed relay.
+    """
+    relays = state_cache.get(device_id)
+    if relays is None:
+        relays = await _load_relays(device_id)
+        if not relays:
+            return None
+        with _cache_lock:
+            # A concurrent update wins over what was just read
+            if not state_cache.add(device_id, relays):
+                relays = state_cache.get(device_id, relays)
+    if relay is not None:
+        return relays.get(relay)
+    return max(relays.values(), key=lambda s: s["last_updated"])
+
+def record_telemetry(device_id, telemetry):
+    telemetry_writer.record((device_id,), {"telemetry": telemetry, "last_seen": datetime.utcnow()})
+
+def log_command(device_id, relay, action, source):
+    command_log.append({
+        "device_id": device_id,
+        "relay": relay,
+        "action": action,
+        "timestamp": datetime.utcnow(),
+        "source": source
+    })
+
+def start():
+    state_writer.start()
+    telemetry_writer.start()
+    command_log.start()
+
+def flush_all():
+    state_writer.flush()
+    telemetry_writer.flush()
+    command_log.flush()
+
+def get_stats():
+    return {
+        "device_states": state_writer.stats(),
+        "device_telemetry": telemetry_writer.stats(),
+        "command_logs": command_log.stats(),
+        "state_cache": state_cache.stats(),
+    }
@@ -0,0 +1,213 @@
+from pymongo import ASCENDING, UpdateOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+from collections import defaultdict
+from datetime import datetime
+import logging
+import uuid
+import os
+from starlette.concurrency import run_in_threadpool
+from database import db, adb, indexes
+from cache import LRUCache
+from users import invalidate_user
+from state_push import push_registry
+from schedule_index import schedules, schedule_doc, schedule_view, list_schedules, delete_device_schedules, DEFAULT_TIMEZONE
+
+logger = logging.getLogger(__name__)
+
+# Rooms, devices and schedules used to be arrays nested in the user document.
+# They now live in their own collections keyed by owner email. Users are moved
+# over on first access (or by migrate_storage.py); see migrate_user. The
+# migration runs on the sync client, everything the routes call is async.
+rooms = db.rooms
+# "devices" is taken by the OTA server's device registry
+devices = db.user_devices
+
+# Owners already known to have nothing left to migrate
+MIGRATED_CACHE_SIZE = int(os.getenv("MIGRATED_CACHE_SIZE", "100000"))
+_migrated = LRUCache(MIGRATED_CACHE_SIZE)
+
+indexes.declare("rooms", ["owner", "name"], unique=True)
+indexes.declare("user_devices", ["owner", "device_id"])
+indexes.declare("user_devices", ["owner", "room_name", "device_id"], unique=True)
+
+def migrate_user(email):
+    """Move a user's embedded rooms into the rooms, devices and schedules collections.
+
+    Writes are upserts, so a migration interrupted halfway is simply run again.
+    The embedded copy is only removed if it did not change while it was being
+    copied; otherwise the user is copied again. Returns True if anything moved.
+    """
+    while True:
+        user = db.users.find_one({"email": email, "rooms": {"$exists": True}}, {"rooms": 1, "timezone": 1})
+        if user is None:
+            _migrated.put(email, True)
+            return False
+        timezone = user.get("timezone") or DEFAULT_TIMEZONE
+        room_ops, device_ops, schedule_ops = [], [], []
+        for room in user["rooms"] or []:
+            room_ops.append(UpdateOne(
+                {"owner": email, "name": room["name"]},
+                {"$setOnInsert": {"description": room.get("description")}},
+                upsert=True
+            ))
+            for device in room.get("devices") or []:
+                device_ops.append(UpdateOne(
+                    {"owner": email, "room_name": room["name"], "device_id": device["device_id"]},
+                    {"$setOnInsert": {"device_name": device.get("device_name"), "added_at": device.get("added_at")}},
+                    upsert=True
+                ))
+                for schedule in device.get("schedules") or []:
+                    try:
+                        doc = schedule_doc(email, device["device_id"], schedule, timezone)
+                    except (KeyError, ValueError) as e:
+                        logger.warning(f"Skipping malformed schedule for {email}: {e}")
+                        continue
+                    schedule_ops.append(doc)
+        # Rooms first, so a device is never visible without its room
+        for collection, ops in ((rooms, room_ops), (devices, device_ops)):
+            if ops:
+                collection.bulk_write(ops, ordered=True)
+        _copy_schedules(email, schedule_ops)
+        result = db.users.update_one(
+            {"_id": user["_id"], "rooms": user["rooms"]},
+            {"$unset": {"rooms": ""}, "$set": {"migrated_at": datetime.utcnow()}}
+        )
+        if result.modified_count:
+            invalidate_user(email)
+            _migrated.put(email, True)
+            logger.info(f"Migrated {len(room_ops)} rooms, {len(device_ops)} devices and "
+                        f"{len(schedule_ops)} schedules for {email}")
+            return True
+        logger.info(f"Rooms of {email} changed during migration, copying again")
+
+def _copy_schedules(email, docs):
+    """Upsert the owner's schedules, re-keying any whose id another owner holds.
+
+    Embedded schedule ids were chosen by clients, so two users can share one.
+    The replacement id is derived from owner and old id, keeping reruns idempotent.
+    """
+    ops = [ReplaceOne({"_id": doc["_id"], "owner": email}, doc, upsert=True) for doc in docs]
+    if not ops:
+        return
+    try:
+        schedules.bulk_write(ops, ordered=False)
+    except BulkWriteError as e:
+        retry = []
+        for error in e.details["writeErrors"]:
+            if error["code"] != 11000:
+                raise
+            doc = docs[error["index"]]
+            new_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{email}/{doc['_id']}"))
+            logger.warning(f"Schedule id {doc['_id']} of {email} is taken, storing it as {new_id}")
+            retry.append(ReplaceOne({"_id": new_id, "owner": email}, {**doc, "_id": new_id}, upsert=True))
+        schedules.bulk_write(retry, ordered=False)
+
+async def ensure_normalized(email):
+    """Migrate the user on first access; a no-op once they are known to be done."""
+    if _migrated.get(email) is None:
+        await run_in_threadpool(migrate_user, email)
+
+DEVICE_FIELDS = {"device_id": 1, "device_name": 1, "added_at": 1, "room_name": 1}
+
+async def _schedules_by_device(owner, device_ids=None):
+    grouped = defaultdict(list)
+    async for doc in list_schedules(owner, device_ids):
+        grouped[doc["device_id"]].append(schedule_view(doc))
+    return grouped
+
+def _device_view(doc, device_schedules):
+    device = {"device_id": doc["device_id"], "device_name": doc.get("device_name"), "added_at": doc.get("added_at")}
+    if device_schedules:
+        device["schedules"] = device_schedules
+    return device
+
+def list_devices(owner, device_ids=None):
+    query = {"owner": owner}
+    if device_ids is not None:
+        query["device_id"] = {"$in": list(device_ids)}
+    return adb.user_devices.find(query, DEVICE_FIELDS).sort("_id", ASCENDING)
+
+async def room_tree(owner):
+    """Rooms with their devices and schedules nested, as stored before normalization."""
+    by_device = await _schedules_by_device(owner)
+    by_room = defaultdict(list)
+    async for doc in list_devices(owner):
+        by_room[doc["room_name"]].append(_device_view(doc, by_device.get(doc["device_id"])))
+    return [
+        {"name": room["name"], "description": room.get("description"), "devices": by_room.get(room["name"], [])}
+        async for room in adb.rooms.find({"owner": owner}, {"name": 1, "description": 1}).sort("_id", ASCENDING)
+    ]
+
+async def device_list(owner):
+    by_device = await _schedules_by_device(owner)
+    result = []
+    async for doc in list_devices(owner):
+        device = _device_view(doc, by_device.get(doc["device_id"]))
+        device["room_name"] = doc["room_name"]
+        device["name"] = doc.get("device_name") or ""
+        result.append(device)
+    return result
+
+async def schedule_list(owner):
+    by_device = await _schedules_by_device(owner)
+    # Only the devices that have schedules are needed
+    return [
+        {**schedule, "device_id": doc["device_id"], "device_name": doc.get("device_name", ""), "room_name": doc["room_name"]}
+        async for doc in list_devices(owner, by_device)
+        for schedule in by_device[doc["device_id"]]
+    ]
+
+async def user_device_ids(owner):
+    return await adb.user_devices.distinct("device_id", {"owner": owner})
+
+async def room_device_ids(owner, room_name):
+    return await adb.user_devices.distinct("device_id", {"owner": owner, "room_name": room_name})
+
+async def room_exists(owner, name=None):
+    query = {"owner": owner} if name is None else {"owner": owner, "name": name}
+    return await adb.rooms.find_one(query, {"_id": 1}) is not None
+
+async def device_exists(owner, device_id):
+    return await adb.user_devices.find_one({"owner": owner, "device_id": device_id}, {"_id": 1}) is not None
+
+async def _refresh_push(owner):
+    # Open state subscriptions follow the owner's device list
+    if push_registry.is_connected(owner):
+        push_registry.resubscribe(owner, await user_device_ids(owner))
+
+async def add_room(owner, name, description):
+    """Raises DuplicateKeyError if the owner already has a room by that name."""
+    await adb.rooms.insert_one({"owner": owner, "name": name, "description": description})
+
+async def add_device(owner, room_name, device_id, device_name):
+    """Raises DuplicateKeyError if the device is already in that room."""
+    await adb.user_devices.insert_one({
+        "owner": owner,
+        "room_name": room_name,
+        "device_id": device_id,
+        "device_name": device_name,
+        "added_at": datetime.utcnow()
+    })
+    await _refresh_push(owner)
+
+async def delete_room(owner, name):
+    """Delete a room and the devices in it. Returns False if there was no such room."""
+    result = await adb.rooms.delete_one({"owner": owner, "name": name})
+    if result.deleted_count == 0:
+        return False
+    device_ids = await adb.user_devices.distinct("device_id", {"owner": owner, "room_name": name})
+    await adb.user_devices.delete_many({"owner": owner, "room_name": name})
+    # The same device can sit in several rooms; keep its schedules while it does
+    remaining = set(await adb.user_devices.distinct("device_id", {"owner": owner, "device_id": {"$in": device_ids}}))
+    await delete_device_schedules(owner, set(device_ids) - remaining)
+    await _refresh_push(owner)
+    return True
+
+async def delete_device(owner, device_id):
+    """Remove a device from every room. Returns False if it was in none."""
+    result = await adb.user_devices.delete_many({"owner": owner, "device_id": device_id})
+    if result.deleted_count == 0:
+        return False
+    await delete_device_schedules(owner, [device_id])
+    await _refresh_push(owner)
+    return True
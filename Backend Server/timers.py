@@ -0,0 +1,193 @@
+from datetime import datetime, timedelta, timezone
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
+import itertools
+import threading
+import logging
+import heapq
+import time
+import os
+from database import db, adb, indexes
+from leases import lease_manager, shard_of, backfill_shards
+from mqtt_client import publish
+
+logger = logging.getLogger(__name__)
+
+timers = db.timers
+MAX_WAIT_SECONDS = 30
+# Timers created on other workers are picked up by polling on created_at
+POLL_SECONDS = int(os.getenv("TIMER_POLL_SECONDS", "2"))
+POLL_OVERLAP_SECONDS = 5
+
+indexes.declare("timers", ["owner", "device_id", "execute_at"])
+indexes.declare("timers", ["shard", "created_at"])
+
+def to_timestamp(when):
+    """Naive datetimes are treated as UTC."""
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.timestamp()
+
+class TimerEngine:
+    """Min-heap of pending one-shot timers.
+
+    Cancelled timers are removed from the id map and skipped when they reach the
+    top of the heap, so both schedule and cancel are O(log n) or better.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []  # (execute_at, seq, timer_id)
+        self._pending = {}  # timer_id -> timer document
+        self._seq = itertools.count()
+        self.fired = 0
+        self.cancelled = 0
+
+    def schedule(self, timer):
+        with self._cond:
+            self._pending[timer["_id"]] = timer
+            heapq.heappush(self._heap, (to_timestamp(timer["execute_at"]), next(self._seq), timer["_id"]))
+            self._cond.notify()
+
+    def cancel(self, timer_id):
+        with self._cond:
+            if self._pending.pop(timer_id, None) is None:
+                return False
+            self.cancelled += 1
+            # Drop tombstones once they outnumber live timers
+            if len(self._heap) > 2 * len(self._pending) + 1000:
+                self._heap = [e for e in self._heap if e[2] in self._pending]
+                heapq.heapify(self._heap)
+            return True
+
+    def load(self, docs):
+        with self._cond:
+            self._pending = {doc["_id"]: doc for doc in docs}
+            self._heap = [(to_timestamp(doc["execute_at"]), next(self._seq), doc["_id"]) for doc in self._pending.values()]
+            heapq.heapify(self._heap)
+            self._cond.notify()
+
+    def is_pending(self, timer_id):
+        with self._cond:
+            return timer_id in self._pending
+
+    def drop(self, predicate):
+        with self._cond:
+            for timer_id in [k for k, timer in self._pending.items() if predicate(timer)]:
+                del self._pending[timer_id]
+
+    def pop_due(self):
+        """Block until at least one timer is due and return the due timers."""
+        with self._cond:
+            while True:
+                while self._heap and self._heap[0][2] not in self._pending:
+                    heapq.heappop(self._heap)
+                timeout = MAX_WAIT_SECONDS
+                if self._heap:
+                    timeout = self._heap[0][0] - time.time()
+                    if timeout <= 0:
+                        break
+                self._cond.wait(min(timeout, MAX_WAIT_SECONDS))
+            due, now = [], time.time()
+            while self._heap and self._heap[0][0] <= now:
+                _, _, timer_id = heapq.heappop(self._heap)
+                timer = self._pending.pop(timer_id, None)
+                if timer is not None:
+                    due.append(timer)
+            self.fired += len(due)
+            return due
+
+    def stats(self):
+        with self._cond:
+            return {
+                "pending": len(self._pending),
+                "heap_entries": len(self._heap),
+                "next_fire_in_seconds": round(self._heap[0][0] - time.time(), 3) if self._heap else None,
+                "fired": self.fired,
+                "cancelled": self.cancelled,
+            }
+
+timer_engine = TimerEngine()
+
+def create_timer(owner, timer_id, device_id, relay, action, execute_at):
+    timer = {
+        "_id": timer_id,
+        "owner": owner,
+        "shard": shard_of(owner),
+        "device_id": device_id,
+        "relay": relay,
+        "action": action,
+        "execute_at": execute_at,
+        "created_at": datetime.utcnow(),
+    }
+    timers.insert_one(timer)
+    if lease_manager.owns(owner):
+        timer_engine.schedule(timer)
+    return timer
+
+def list_timers(owner, device_id):
+    return adb.timers.find({"owner": owner, "device_id": device_id}).sort("execute_at", ASCENDING)
+
+async def delete_timer(owner, timer_id):
+    result = await adb.timers.delete_one({"_id": timer_id, "owner": owner})
+    if result.deleted_count:
+        timer_engine.cancel(timer_id)
+    return result.deleted_count > 0
+
+def _claim(timer):
+    # Deleting before publishing makes each timer fire once, even if it was
+    # cancelled on another worker or two nodes briefly overlap on a shard
+    try:
+        return timers.find_one_and_delete({"_id": timer["_id"]}, projection={"_id": 1}) is not None
+    except PyMongoError as e:
+        logger.error(f"Error claiming timer {timer['_id']}: {str(e)}")
+        return False
+
+def _run_timers():
+    while True:
+        due = timer_engine.pop_due()
+        executed = 0
+        for timer in due:
+            if not lease_manager.owns(timer["owner"]) or not _claim(timer):
+                continue
+            try:
+                publish(f"device/{timer['device_id']}/{timer['relay']}/set", timer["action"])
+                executed += 1
+            except Exception as e:
+                logger.error(f"Error executing timer {timer['_id']}: {str(e)}")
+        logger.info(f"Executed {executed} timers")
+
+def _owned(shards, query=None):
+    return timers.find({**(query or {}), "shard": {"$in": list(shards)}})
+
+def _poll_new_timers():
+    since = datetime.utcnow()
+    while True:
+        time.sleep(POLL_SECONDS)
+        started = datetime.utcnow()
+        try:
+            query = {"created_at": {"$gte": since - timedelta(seconds=POLL_OVERLAP_SECONDS)}}
+            for timer in _owned(lease_manager.held(), query):
+                if not timer_engine.is_pending(timer["_id"]):
+                    timer_engine.schedule(timer)
+            since = started
+        except PyMongoError as e:
+            logger.error(f"Error polling timers: {str(e)}")
+
+def _on_shards_changed(acquired, lost):
+    if lost:
+        timer_engine.drop(lambda timer: shard_of(timer["owner"]) in lost)
+    for timer in _owned(acquired) if acquired else ():
+        timer_engine.schedule(timer)
+
+def get_stats():
+    return timer_engine.stats()
+
+def start_timers():
+    backfill_shards(timers)
+    lease_manager.start()
+    timer_engine.load(_owned(lease_manager.held()))
+    lease_manager.add_listener(_on_shards_changed)
+    logger.info(f"Loaded {timer_engine.stats()['pending']} pending timers")
+    threading.Thread(target=_run_timers, daemon=True).start()
+    threading.Thread(target=_poll_new_timers, daemon=True).start()
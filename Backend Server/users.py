@@ -0,0 +1,25 @@
+import os
+from database import adb
+from cache import LRUCache
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "30"))
+
+# email -> {fields tuple: projected user document}. Per process, so other
+# workers can serve a stale copy for at most the TTL after a write.
+user_cache = LRUCache(USER_CACHE_SIZE, ttl=USER_CACHE_TTL_SECONDS)
+
+async def load_user(email, fields):
+    """The user's document limited to fields, or None if there is no such user."""
+    fields = tuple(sorted(fields))
+    cached = user_cache.get(email)
+    if cached is not None and fields in cached:
+        return cached[fields]
+    user = await adb.users.find_one({"email": email}, {field: 1 for field in fields})
+    if user is not None:
+        user_cache.put(email, {**(cached or {}), fields: user})
+    return user
+
+def invalidate_user(email):
+    """Call after any write to a user document."""
+    user_cache.invalidate(email)
@@ -1,9 +1,97 @@
 from passlib.context import CryptContext
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import multiprocessing
+import threading
+import asyncio
+import time
+import os
+from utils.stats import latency_summary
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Changing the cost makes existing hashes outdated; they are rehashed on next login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Hashing requests queued or running at once; beyond this callers get HashPoolBusy
+HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", str(HASH_WORKERS * 8)))
+LATENCY_SAMPLES = 1000
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
 
 def hash_password(pwd):
     return pwd_context.hash(pwd)
 
 def verify_password(plain, hashed):
-    return pwd_context.verify(plain, hashed)
\ No newline at end of file
+    return pwd_context.verify(plain, hashed)
+
+def verify_and_update(plain, hashed):
+    """Return (valid, new_hash); new_hash is set when the stored hash uses an outdated cost."""
+    return pwd_context.verify_and_update(plain, hashed)
+
+class HashPoolBusy(Exception):
+    """Raised when the admission queue is full and the request was not queued."""
+
+_pool = None
+_pool_lock = threading.Lock()
+_pending = 0
+_latencies = {"hash": deque(maxlen=LATENCY_SAMPLES), "verify": deque(maxlen=LATENCY_SAMPLES)}
+counters = {"hashed": 0, "verified": 0, "rehashed": 0, "rejected": 0}
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned, not forked: by now the process runs MQTT, scheduler and
+            # flush threads, and a forked child could inherit one of their locks held
+            _pool = ProcessPoolExecutor(max_workers=HASH_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+async def _submit(kind, fn, *args):
+    global _pending
+    with _pool_lock:
+        if _pending >= HASH_MAX_PENDING:
+            counters["rejected"] += 1
+            raise HashPoolBusy(f"{_pending} password hashing requests pending")
+        _pending += 1
+    started = time.monotonic()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_get_pool(), fn, *args)
+    finally:
+        with _pool_lock:
+            _pending -= 1
+        _latencies[kind].append(time.monotonic() - started)
+
+async def hash_password_async(pwd):
+    hashed = await _submit("hash", hash_password, pwd)
+    counters["hashed"] += 1
+    return hashed
+
+async def verify_and_update_async(plain, hashed):
+    valid, new_hash = await _submit("verify", verify_and_update, plain, hashed)
+    counters["verified"] += 1
+    if new_hash:
+        counters["rehashed"] += 1
+    return valid, new_hash
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def get_stats():
+    return {
+        "rounds": BCRYPT_ROUNDS,
+        "workers": HASH_WORKERS,
+        "pending": _pending,
+        "max_pending": HASH_MAX_PENDING,
+        **counters,
+        "hash_latency_ms": latency_summary(_latencies["hash"]),
+        "verify_latency_ms": latency_summary(_latencies["verify"]),
+    }
@@ -0,0 +1,109 @@
+"""Startup index bootstrapper for the API server.
+
+The OTA server is deployed on its own and keeps a minimal equivalent,
+ensure_indexes() in OTA/ota_server/database.py, for its single index.
+
+Modules declare the indexes their queries rely on next to the collection they
+use; the server creates them once at startup in a background thread so a slow
+build never blocks requests. create_index is a no-op for an index that already
+exists, so this is safe to run on every start.
+"""
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+class IndexManager:
+    def __init__(self, db):
+        self.db = db
+        self._declared = []  # (collection, keys, options)
+        self._lock = threading.Lock()
+        self.errors = {}  # "collection.index" -> why it could not be created
+        self.ready = threading.Event()
+
+    def declare(self, collection, keys, **options):
+        """Declare an index; keys are field names (ascending) or (field, direction) pairs."""
+        keys = [(k, ASCENDING) if isinstance(k, str) else tuple(k) for k in keys]
+        options.setdefault("name", "_".join(f"{field}_{direction}" for field, direction in keys))
+        with self._lock:
+            if not any(c == collection and o["name"] == options["name"] for c, _, o in self._declared):
+                self._declared.append((collection, keys, options))
+
+    def declared(self):
+        with self._lock:
+            return list(self._declared)
+
+    def ensure(self):
+        """Create every declared index and return how many exist afterwards."""
+        ok = 0
+        for collection, keys, options in self.declared():
+            name = f"{collection}.{options['name']}"
+            try:
+                self.db[collection].create_index(keys, **options)
+                self.errors.pop(name, None)
+                ok += 1
+            except PyMongoError as e:
+                # e.g. duplicate values blocking a unique index; shows up as missing
+                self.errors[name] = str(e)
+                logger.error(f"Could not create index {name}: {str(e)}")
+        self.ready.set()
+        return ok
+
+    def ensure_in_background(self):
+        thread = threading.Thread(target=self._bootstrap, name="index-bootstrap", daemon=True)
+        thread.start()
+        return thread
+
+    def _bootstrap(self):
+        created = self.ensure()
+        logger.info(f"Ensured {created} of {len(self.declared())} declared indexes")
+        try:
+            report = self.report()
+        except PyMongoError as e:
+            logger.error(f"Error checking indexes: {str(e)}")
+            return
+        for index in report["missing"]:
+            logger.warning(f"Missing index {index['collection']}.{index['name']}")
+        for index in report["unused"] or []:
+            logger.warning(f"Index {index['collection']}.{index['name']} has not been used since {index['since']}")
+
+    def missing(self):
+        """Declared indexes that do not exist on the server."""
+        existing = {}
+        result = []
+        for collection, keys, options in self.declared():
+            if collection not in existing:
+                existing[collection] = {
+                    tuple((field, int(direction) if isinstance(direction, float) else direction) for field, direction in info["key"])
+                    for info in self.db[collection].index_information().values()
+                }
+            if tuple(keys) not in existing[collection]:
+                result.append({"collection": collection, "name": options["name"], "keys": keys})
+        return result
+
+    def unused(self):
+        """Indexes on the declared collections with no recorded use since the server started.
+
+        Returns None where $indexStats is not available.
+        """
+        result = []
+        for collection in sorted({c for c, _, _ in self.declared()}):
+            try:
+                stats = list(self.db[collection].aggregate([{"$indexStats": {}}]))
+            except (PyMongoError, NotImplementedError):
+                return None
+            for index in stats:
+                if index["name"] != "_id_" and index["accesses"]["ops"] == 0:
+                    result.append({"collection": collection, "name": index["name"], "since": index["accesses"]["since"]})
+        return result
+
+    def report(self):
+        return {
+            "ready": self.ready.is_set(),
+            "declared": len(self.declared()),
+            "missing": self.missing(),
+            "unused": self.unused(),
+            "errors": dict(self.errors),
+        }
@@ -0,0 +1,12 @@
+"""Small helpers for the latency figures reported on /metrics and by the benchmarks."""
+
+def percentile(sorted_samples, p):
+    """The p-th (0-1) sample of an already sorted sequence, in milliseconds, or None if empty."""
+    if not sorted_samples:
+        return None
+    return round(sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * p))] * 1000, 2)
+
+def latency_summary(samples):
+    """p50, p99 and max in milliseconds of latencies given in seconds."""
+    samples = sorted(samples)
+    return {"p50": percentile(samples, 0.5), "p99": percentile(samples, 0.99), "max": percentile(samples, 1.0)}